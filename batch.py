@@ -0,0 +1,320 @@
+"""
+Headless batch processing of many PDFs, without the Tkinter app:
+
+    python -m batch ./books --output index.jsonl
+    python -m batch manifest.txt --output index.parquet --backend openai
+
+The inputs are PDF files, directories (searched recursively) or manifests
+(one PDF path per line, or JSONL lines with a "path"). The index pages of
+every document are located and extracted in a process pool, and the chunks
+of all the documents go through one asyncio LLM pipeline: a single client,
+with one global rate limit and one limit of concurrent calls. The small
+chunks of different documents are packed into shared requests.
+
+The output has one record per term: the file, the term, its occurrences and
+the page difference of the file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from src.document import Document
+from src.index import Index
+from src.llm_backends import make_backend, BACKENDS
+from src.llm_cache import MODES, USE
+from src.prompt import PromptStats, RequestPacker
+from utils.metrics import metrics
+
+
+def find_pdfs(inputs):
+    """Returns the PDF paths of the inputs, in order and without duplicates."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for directory, _, files in sorted(os.walk(item)):
+                paths.extend(os.path.join(directory, name) for name in sorted(files) if name.lower().endswith(".pdf"))
+        elif item.lower().endswith(".pdf"):
+            paths.append(item)
+        else:
+            base = os.path.dirname(item)
+            with open(item, encoding="utf-8") as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    path = json.loads(line)["path"] if line.startswith("{") else line
+                    # Relative paths are relative to the manifest
+                    paths.append(os.path.join(base, path))
+    seen = set()
+    paths = [os.path.normpath(path) for path in paths]
+    return [path for path in paths if not (path in seen or seen.add(path))]
+
+
+def locate_document(path, options):
+    """
+    Finds the index pages of a document and extracts their text. Runs in a
+    worker process, so it only returns plain data.
+
+    Returns:
+        dict: The "path", "index_pages", "page_difference", "text" and the
+        "prompt_stats" of the text, or the "error" if the document could not
+        be read.
+    """
+    try:
+        with Document("pdf", path, **options) as document:
+            document.filter_index_pages()
+            text = asyncio.run(document.extract_index_pages_text()) if document.index_pages else ""
+            return {
+                "path": path,
+                "index_pages": document.index_pages,
+                "page_difference": document.page_difference,
+                "text": text,
+                "prompt_stats": document.prompt_stats,
+            }
+    except Exception as e:
+        return {"path": path, "error": f"{type(e).__name__}: {e}"}
+
+
+def load_saved_index(path, options):
+    """
+    Reads the index saved by an earlier run for a document. Runs in a thread,
+    as hashing the PDF and reading the index file would block the event loop.
+
+    Returns:
+        dict: The "file_digest" of the PDF, None when caching is disabled,
+        and the "index_pages", "page_difference" and "entries" of the index
+        if one was saved for the current file.
+    """
+    with Document("pdf", path, **options) as document:
+        if not document.load_index():
+            return {"file_digest": document.file_digest}
+        return {
+            "file_digest": document.file_digest,
+            "index_pages": document.index_pages,
+            "page_difference": document.page_difference,
+            # Copied, the saved index is unmapped when the document is closed
+            "entries": [Index(entry.term, list(entry.occurrences)) for entry in document.original_index],
+        }
+
+
+class JSONLWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes the records of each document as a row group. Needs pyarrow."""
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ("file", pyarrow.string()),
+            ("term", pyarrow.string()),
+            ("occurrences", pyarrow.list_(pyarrow.list_(pyarrow.int64()))),
+            ("page_difference", pyarrow.int64()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, records):
+        if records:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(records, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, output_format=None):
+    if (output_format or ("parquet" if path.lower().endswith(".parquet") else "jsonl")) == "parquet":
+        return ParquetWriter(path)
+    return JSONLWriter(path)
+
+
+async def run_batch(paths, writer, args):
+    """
+    Processes the documents and writes their terms as they are parsed.
+
+    Returns:
+        list[dict]: The summary of each document: "path", "index_pages",
+        "page_difference", "terms", "tokens_saved" and "error".
+    """
+    loop = asyncio.get_running_loop()
+    backend_options = {"url": args.llm_url} if args.llm_url else {}
+    client = make_backend(args.backend, **backend_options)
+    llm_semaphore = asyncio.Semaphore(args.llm_concurrency)
+    # Each document in flight holds its caches and index text, so only a few are started at once
+    documents = asyncio.Semaphore(args.max_documents or args.workers + args.llm_concurrency)
+    llm_packer = None if args.no_pack else RequestPacker(client)
+    prompt_stats = PromptStats()  # Of all the documents
+    cache_options = {"use_cache": not args.no_cache, "cache_dir": args.cache_dir, "llm_cache_mode": args.llm_cache}
+    locate_options = dict(cache_options, locate_mode=args.locate_mode)
+
+    def write_entries(path, page_difference, entries, summary):
+        records = [
+            {
+                "file": path,
+                "term": entry.term,
+                "occurrences": [list(occurrence) for occurrence in entry.occurrences],
+                "page_difference": page_difference,
+            }
+            for entry in entries
+        ]
+        writer.write(records)
+        summary["terms"] += len(records)
+
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+
+    async def locate(path):
+        """
+        Runs `locate_document` in the process pool. A worker that dies, like
+        a crash of PyMuPDF on a malformed PDF, breaks the pool and fails every
+        document it was locating: the pool is replaced, and each of them is
+        located again in a process of its own, so only the document that
+        crashes again fails.
+        """
+        nonlocal executor
+        pool = executor
+        try:
+            return await loop.run_in_executor(pool, locate_document, path, locate_options)
+        except BrokenProcessPool:
+            if executor is pool:
+                pool.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=args.workers)
+        alone = ProcessPoolExecutor(max_workers=1)
+        try:
+            return await loop.run_in_executor(alone, locate_document, path, locate_options)
+        except BrokenProcessPool as e:
+            return {"path": path, "error": f"{type(e).__name__}: the worker process died locating the index"}
+        finally:
+            alone.shutdown(wait=False)
+
+    async def process(path):
+        async with documents:
+            return await process_document(path)
+
+    async def process_document(path):
+        try:
+            saved = await loop.run_in_executor(None, load_saved_index, path, cache_options)
+            if "entries" in saved:
+                # Processed by an earlier run
+                summary = {"path": path, "index_pages": saved["index_pages"],
+                           "page_difference": saved["page_difference"], "error": None, "terms": 0,
+                           "tokens_saved": 0}
+                write_entries(path, saved["page_difference"], saved["entries"], summary)
+                return summary
+        except Exception as e:
+            return {"path": path, "index_pages": None, "page_difference": None,
+                    "error": f"{type(e).__name__}: {e}", "terms": 0, "tokens_saved": 0}
+        located = await locate(path)
+        summary = {key: located.get(key) for key in ("path", "index_pages", "page_difference", "error")}
+        summary["terms"] = 0
+        summary["tokens_saved"] = 0
+        if located.get("error") or not located["index_pages"]:
+            return summary
+        # Opening the caches and writing the index file are done in threads, off the event loop
+        document = await loop.run_in_executor(None, partial(
+            Document, "pdf", path, llm_client=client, llm_semaphore=llm_semaphore, llm_packer=llm_packer,
+            **cache_options
+        ))
+        try:
+            document.index_pages = located["index_pages"]
+            document.page_difference = located["page_difference"]
+            document.file_digest = saved["file_digest"]
+            document.prompt_stats.add(located["prompt_stats"])
+            try:
+                async for _, _, entries in document.stream_index(located["text"]):
+                    write_entries(path, document.page_difference, entries, summary)
+                await loop.run_in_executor(None, document.save_index)
+            except Exception as e:
+                summary["error"] = f"{type(e).__name__}: {e}"
+            prompt_stats.add(document.prompt_stats)
+            # Packing is counted for the whole run
+            summary["tokens_saved"] = document.prompt_stats.report()["tokens_saved"]
+        finally:
+            document.close()
+        return summary
+
+    summaries = []
+    try:
+        async with client:
+            tasks = [asyncio.ensure_future(process(path)) for path in paths]
+            for task in asyncio.as_completed(tasks):
+                summary = await task
+                summaries.append(summary)
+                status = summary["error"] or f"{summary['terms']} terms, index pages {summary['index_pages']}"
+                print(f"[{len(summaries)}/{len(paths)}] {summary['path']}: {status}", file=sys.stderr)
+    finally:
+        executor.shutdown()
+    if llm_packer is not None:
+        prompt_stats.add(llm_packer.stats)
+    print(prompt_stats.summary(), file=sys.stderr)
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse the index of many PDFs into one JSONL or Parquet file.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories or manifests of PDF paths.")
+    parser.add_argument("--output", "-o", default="index.jsonl", help="The output file, .jsonl or .parquet.")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), help="Defaults to the output extension.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes locating the index pages.")
+    parser.add_argument("--backend", default="gemini", choices=sorted(BACKENDS))
+    parser.add_argument("--llm-url", help="Overrides the URL of the backend, e.g. a local server.")
+    parser.add_argument("--llm-concurrency", type=int, default=20, help="Concurrent LLM calls over all documents.")
+    parser.add_argument("--max-documents", type=int,
+                        help="Documents processed at once, defaults to the workers plus the LLM concurrency.")
+    parser.add_argument("--no-pack", action="store_true",
+                        help="Send each chunk in its own request instead of packing the small ones.")
+    parser.add_argument("--locate-mode", default="backward", choices=("backward", "full"))
+    parser.add_argument("--cache-dir", help="One cache directory for all the documents.")
+    parser.add_argument("--llm-cache", default=USE, choices=MODES)
+    parser.add_argument("--no-cache", action="store_true", help="Disable the page and LLM caches.")
+    parser.add_argument("--summary", help="Write the JSON summary of each document to this file.")
+    parser.add_argument("--metrics", help="Write the metrics of the run to this JSON file, and in the Prometheus "
+                                          "format to the same name with .prom. Pages located in the worker "
+                                          "processes are not counted.")
+    args = parser.parse_args(argv)
+    if args.metrics:
+        metrics.enable()
+
+    paths = find_pdfs(args.inputs)
+    if not paths:
+        raise SystemExit("No PDF files found.")
+    print(f"Processing {len(paths)} PDF files with {args.workers} workers.", file=sys.stderr)
+    start = time.perf_counter()
+    writer = open_writer(args.output, args.format)
+    try:
+        summaries = asyncio.run(run_batch(paths, writer, args))
+    finally:
+        writer.close()
+    failed = sum(1 for summary in summaries if summary["error"])
+    print(
+        f"Done in {time.perf_counter() - start:.1f}s: {sum(summary['terms'] for summary in summaries)} terms, "
+        f"{failed} failed of {len(summaries)} files.",
+        file=sys.stderr,
+    )
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summaries, f, indent=2)
+    if args.metrics:
+        metrics.write_reports(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Benchmark of the index pipeline on synthetic books.
+
+Generates a book with bench/synthetic_book.py, times each stage of the
+pipeline against the in-process fake LLM, or the local mock server of
+src/mock_llm_server.py, and prints a JSON report:
+
+    python -m bench.run --body-pages 600 --columns 3 --output report.json
+    python -m bench.run --backend mock --latency lognormal:0.8,0.4 --rate-429 0.05
+    python -m bench.run --tokens-per-second 400 --stream
+    python -m bench.run --body-pages 800 --plates 200 500
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import fitz
+
+from bench.synthetic_book import make_book
+from src.llm_backends import FakeBackend, LocalBackend
+from src.mock_llm_server import MockLLMServer, parse_latency
+from src.document import Document
+from src.page_offsets import estimate_page_labels
+from utils.multi_column import column_boxes, column_text
+from utils.metrics import metrics
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process and of its finished children, in bytes."""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+
+def best_time(function, repeat):
+    """
+    Runs `function` `repeat` times and returns the shortest time in seconds
+    and the result of that run, so the other stats of a report come from the
+    run that was timed.
+    """
+    best = None
+    best_result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best, best_result = elapsed, result
+    return best, best_result
+
+
+def rate(count, seconds):
+    return round(count / seconds, 2) if seconds else None
+
+
+def share(count, total):
+    return round(count / total, 4) if total else None
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """Hides the progress prints of the pipeline unless `verbose` is set."""
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def bench_filter(path, page_count, repeat, workers, cache_dir):
+    """Times `filter_index_pages` in both modes, without cache and with a warm page cache."""
+    results = {}
+
+    def locate(mode, use_cache):
+        document = Document("pdf", path, scan_workers=workers, use_cache=use_cache, cache_dir=cache_dir,
+                            locate_mode=mode)
+        document.filter_index_pages()
+        return document
+
+    for mode in ("full", "backward"):
+        seconds, document = best_time(lambda: locate(mode, False), repeat)
+        results[f"filter_index_pages_{mode}"] = {
+            "seconds": round(seconds, 4),
+            "pages_per_second": rate(page_count, seconds),
+            "index_pages": document.index_pages,
+            "page_difference": document.page_difference,
+        }
+        locate(mode, True)  # Fill the cache
+        seconds, _ = best_time(lambda: locate(mode, True), repeat)
+        results[f"filter_index_pages_{mode}_cached"] = {
+            "seconds": round(seconds, 4),
+            "pages_per_second": rate(page_count, seconds),
+        }
+    return results, document
+
+
+def bench_page_labels(path, truth, repeat):
+    """
+    Times `estimate_page_labels` and scores its labels and page lookups
+    against the printed labels of the book, with the lookups of the single
+    page difference for comparison.
+    """
+    numbered = [(page_number, label) for page_number, label in enumerate(truth["page_labels"], 1) if label]
+    body = [(page_number, int(label)) for page_number, label in numbered if label.isdigit()]
+    with fitz.open(path) as pdf:
+        seconds, labels = best_time(lambda: estimate_page_labels(pdf), repeat)
+    difference = truth["page_difference"]
+    return {
+        "page_labels": {
+            "seconds": round(seconds, 4),
+            "pages_read": labels.pages_read,
+            "segments": len(labels.segments),
+            "label_accuracy": share(sum(labels.label(page) == label for page, label in numbered), len(numbered)),
+            "lookup_accuracy": share(sum(labels.pdf_page(number) == page for page, number in body), len(body)),
+            "page_difference_lookup_accuracy": share(
+                sum(number + difference == page for page, number in body), len(body)
+            ),
+        },
+    }
+
+
+def bench_columns(path, index_pages, repeat):
+    """Times `column_boxes` and the column-aware text extraction on the index pages."""
+    with fitz.open(path) as pdf:
+        pages = [pdf.load_page(page_number - 1) for page_number in index_pages]
+        boxes_seconds, boxes = best_time(lambda: [column_boxes(page, no_image_text=False) for page in pages], repeat)
+        text_seconds, _ = best_time(lambda: [column_text(page) for page in pages], repeat)
+    return {
+        "column_boxes": {
+            "seconds": round(boxes_seconds, 4),
+            "pages_per_second": rate(len(pages), boxes_seconds),
+            "boxes": sum(len(page_boxes) for page_boxes in boxes),
+        },
+        "column_text": {
+            "seconds": round(text_seconds, 4),
+            "pages_per_second": rate(len(pages), text_seconds),
+        },
+    }
+
+
+def bench_parse(path, index_pages, repeat, make_client, hybrid_parse, stream_llm=False):
+    """Times the chunking and `parse_index` of the index text with the clients of `make_client`."""
+    results = {}
+
+    def new_document(client=None):
+        document = Document("pdf", path, use_cache=False, hybrid_parse=hybrid_parse, llm_client=client,
+                            stream_llm=stream_llm)
+        document.index_pages = list(index_pages)
+        return document
+
+    document = new_document()
+    text = asyncio.run(document.extract_index_pages_text())
+    seconds, chunks = best_time(lambda: document.plan_chunks(text), repeat)
+    llm_chunks = sum(isinstance(chunk, str) for chunk in chunks)
+    results["chunking"] = {
+        "seconds": round(seconds, 4),
+        "chunks": len(chunks),
+        "llm_chunks": llm_chunks,
+        "chunks_per_second": rate(len(chunks), seconds),
+        "lines_per_second": rate(len(text.splitlines()), seconds),
+    }
+
+    def parse():
+        client = make_client()
+        document = new_document(client)
+
+        async def parse_and_close():
+            async with client:
+                await document.parse_index(text)
+
+        asyncio.run(parse_and_close())
+        return document
+
+    seconds, parsed = best_time(parse, repeat)
+    # The tokens saved on the extracted text, then on the requests
+    parsed.prompt_stats.add(document.prompt_stats)
+    document = parsed
+    results["parse_index"] = {
+        "seconds": round(seconds, 4),
+        "chunks_per_second": rate(len(chunks), seconds),
+        "llm_chunks_per_second": rate(llm_chunks, seconds),
+        "first_entry_seconds": round(document.first_entry_seconds or 0.0, 4),
+        "entries": len(document.original_index),
+        "prompt": document.prompt_stats.report(),
+    }
+    return results, document
+
+
+def score(document, truth):
+    """Compares the parsed entries with the ground truth of the synthetic book."""
+    expected = Counter((term, tuple(map(tuple, occurrences))) for term, occurrences in truth["entries"])
+    found = Counter(
+        (entry.term, tuple(tuple(occurrence) for occurrence in entry.occurrences)) for entry in document.original_index
+    )
+    matched = sum((expected & found).values())
+    return {
+        "expected": sum(expected.values()),
+        "found": sum(found.values()),
+        "matched": matched,
+        "recall": round(matched / sum(expected.values()), 4) if expected else None,
+    }
+
+
+def run(args):
+    sections = tuple((columns, args.index_pages) for columns in args.columns)
+    report = {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "pymupdf": fitz.VersionBind,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "book": {},
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.pdf or os.path.join(directory, "book.pdf")
+        start = time.perf_counter()
+        truth = make_book(path, args.body_pages, sections, args.front_matter, page_labels=args.page_labels,
+                          plates=tuple(args.plates), seed=args.seed)
+        report["book"].update({
+            "page_count": truth["page_count"],
+            "index_pages": truth["index_pages"],
+            "page_difference": truth["page_difference"],
+            "entries": len(truth["entries"]),
+            "generate_seconds": round(time.perf_counter() - start, 4),
+        })
+        cache_dir = os.path.join(directory, "cache")
+        with quiet(args.verbose):
+            stages, document = bench_filter(path, truth["page_count"], args.repeat, args.workers, cache_dir)
+            report["stages"].update(stages)
+            report["stages"].update(bench_page_labels(path, truth, args.repeat))
+            index_pages = document.index_pages or truth["index_pages"]
+            report["stages"].update(bench_columns(path, index_pages, args.repeat))
+            if args.backend == "mock":
+                with MockLLMServer(port=0, latency=args.latency, rate_429=args.rate_429, rate_500=args.rate_500,
+                                   rate_truncated=args.rate_truncated, seed=args.seed,
+                                   tokens_per_second=args.tokens_per_second) as server:
+                    stages, document = bench_parse(
+                        path, index_pages, args.repeat, lambda: LocalBackend(url=server.gemini_url), not args.no_hybrid,
+                        args.stream,
+                    )
+                report["mock_server"] = server.stats
+            else:
+                stages, document = bench_parse(
+                    path, index_pages, args.repeat,
+                    lambda: FakeBackend(latency=parse_latency(args.latency), seed=args.seed,
+                                        tokens_per_second=args.tokens_per_second),
+                    not args.no_hybrid, args.stream,
+                )
+            report["stages"].update(stages)
+        report["accuracy"] = {
+            "index_pages": document.index_pages == truth["index_pages"],
+            "entries": score(document, truth),
+        }
+    rss, children_rss = peak_rss()
+    report["peak_rss_bytes"] = rss
+    report["peak_rss_children_bytes"] = children_rss
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the index pipeline on a synthetic book.")
+    parser.add_argument("--body-pages", type=int, default=300)
+    parser.add_argument("--index-pages", type=int, default=12, help="Pages of each index section.")
+    parser.add_argument("--columns", type=int, nargs="+", default=[2], choices=(1, 2, 3),
+                        help="Columns of each index section, e.g. --columns 3 2 for two sections.")
+    parser.add_argument("--front-matter", type=int, default=10, help="Roman-numbered pages before the body.")
+    parser.add_argument("--plates", type=int, nargs="*", default=[],
+                        help="Body page numbers followed by an unnumbered plate, which shifts the page difference.")
+    parser.add_argument("--page-labels", action="store_true", help="Set the PDF page labels of the book.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each stage, the fastest is reported.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the full page scan.")
+    parser.add_argument("--backend", default="fake", choices=("fake", "mock"),
+                        help="The in-process fake LLM, or the local mock server over HTTP.")
+    parser.add_argument("--latency", default="fixed:0",
+                        help="Latency distribution of the LLM calls, see mock_llm_server.parse_latency.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of 429 responses of the mock server.")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="Share of 500 responses of the mock server.")
+    parser.add_argument("--rate-truncated", type=float, default=0.0,
+                        help="Share of truncated responses of the mock server.")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Generation speed of the LLM after the latency, 0 for no limit.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Decode the entries while the LLM generates them.")
+    parser.add_argument("--no-hybrid", action="store_true", help="Send every index line to the LLM.")
+    parser.add_argument("--pdf", help="Keep the generated book at this path.")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+    parser.add_argument("--verbose", action="store_true", help="Show the progress prints of the pipeline.")
+    parser.add_argument("--metrics", help="Record the pipeline metrics and write them to this JSON file, "
+                                          "and in the Prometheus format to the same name with .prom.")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+    report = json.dumps(run(args), indent=2)
+    if args.metrics:
+        metrics.write_reports(args.metrics)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
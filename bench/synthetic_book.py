@@ -0,0 +1,254 @@
+import fitz
+import random
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 50
+BODY_FONT_SIZE = 10
+INDEX_FONT_SIZE = 8
+INDEX_LINE_HEIGHT = 11
+SYLLABLES = (
+    "al", "an", "ar", "ba", "be", "ca", "co", "da", "de", "di", "el", "en", "er", "fa", "ga", "ha", "in", "is",
+    "ka", "la", "le", "li", "lo", "ma", "me", "mi", "mo", "na", "ne", "no", "or", "pa", "pe", "ra", "re", "ri",
+    "ro", "sa", "se", "si", "so", "ta", "te", "ti", "to", "un", "va", "ve", "vi", "za",
+)
+
+
+def roman(number):
+    """Returns the lowercase roman numeral of a positive number."""
+    numerals = (
+        (1000, "m"), (900, "cm"), (500, "d"), (400, "cd"), (100, "c"), (90, "xc"),
+        (50, "l"), (40, "xl"), (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i"),
+    )
+    result = ""
+    for value, numeral in numerals:
+        while number >= value:
+            result += numeral
+            number -= value
+    return result
+
+
+def format_occurrence(start, end, abbreviate):
+    """Formats a page or a page range, abbreviated like "182-4" when `abbreviate` is set."""
+    if start == end:
+        return str(start)
+    start_str, end_str = str(start), str(end)
+    if abbreviate and len(start_str) == len(end_str):
+        common = 0
+        while common < len(start_str) - 1 and start_str[common] == end_str[common]:
+            common += 1
+        end_str = end_str[common:]
+    return f"{start_str}-{end_str}"
+
+
+def random_word(rng, syllables=(2, 4)):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(*syllables)))
+
+
+def random_occurrences(rng, first_page, last_page, max_occurrences=4):
+    occurrences = []
+    for start in sorted(rng.sample(range(first_page, last_page + 1), rng.randint(1, max_occurrences))):
+        end = start
+        if rng.random() < 0.25:
+            end = min(last_page, start + rng.randint(1, 12))
+        if occurrences and start <= occurrences[-1][1]:
+            continue
+        occurrences.append((start, end))
+    return occurrences
+
+
+def make_entries(rng, count, first_page, last_page, subtopic_ratio=0.1):
+    """
+    Generates sorted index entries.
+
+    Returns:
+        list[tuple]: The (term, subtopics, occurrences) of each top-level term.
+        A term with subtopics has no occurrences of its own, and each subtopic
+        is a (term, occurrences) tuple.
+    """
+    terms = set()
+    while len(terms) < count:
+        words = [random_word(rng) for _ in range(rng.choice((1, 1, 1, 2, 3)))]
+        terms.add(" ".join(words).capitalize())
+    entries = []
+    for term in sorted(terms):
+        if rng.random() < subtopic_ratio:
+            subtopics = sorted(
+                {random_word(rng): None for _ in range(rng.randint(2, 4))}
+            )
+            entries.append((term, [(sub, random_occurrences(rng, first_page, last_page)) for sub in subtopics], []))
+        else:
+            entries.append((term, [], random_occurrences(rng, first_page, last_page)))
+    return entries
+
+
+def wrap_line(text, width, font_size):
+    """Wraps an index line after a comma when it is wider than `width`."""
+    lines = []
+    while fitz.get_text_length(text, fontsize=font_size) > width:
+        cut = text.rfind(", ", 0, len(text))
+        while cut > 0 and fitz.get_text_length(text[:cut + 1], fontsize=font_size) > width:
+            cut = text.rfind(", ", 0, cut)
+        if cut <= 0:
+            break
+        lines.append(text[:cut + 1])
+        text = text[cut + 2:]
+    lines.append(text)
+    return lines
+
+
+def index_lines(entries, rng, abbreviate_ratio=0.5):
+    """
+    Returns the (indent, text, entry) lines of the entries, with a letter
+    header before each letter. `entry` is the (term, occurrences) of the line
+    as the LLM should output it, or None for the headers and parent terms.
+    """
+    lines = []
+    letter = None
+    for term, subtopics, occurrences in entries:
+        if term[0] != letter:
+            letter = term[0]
+            lines.append((0, letter, None))
+        if subtopics:
+            lines.append((0, f"{term}:", None))
+            for sub, sub_occurrences in subtopics:
+                pages = ", ".join(format_occurrence(s, e, rng.random() < abbreviate_ratio) for s, e in sub_occurrences)
+                lines.append((1, f"{sub}, {pages}", (f"under {term}: {sub}", sub_occurrences)))
+        else:
+            pages = ", ".join(format_occurrence(s, e, rng.random() < abbreviate_ratio) for s, e in occurrences)
+            lines.append((0, f"{term}, {pages}", (term, occurrences)))
+    return lines
+
+
+def insert_footer(page, label):
+    page.insert_text((PAGE_WIDTH / 2 - 10, PAGE_HEIGHT - 25), label, fontsize=BODY_FONT_SIZE)
+
+
+def make_book(path, body_pages=300, index_sections=((2, 12),), front_matter=10, back_matter=2,
+              first_page_number=1, entries_per_column=55, page_labels=False, plates=(), seed=0):
+    """
+    Generates a synthetic book with PyMuPDF and returns its ground truth.
+
+    The book has roman-numbered front matter, arabic-numbered body pages and
+    one or more index sections of 1 to 3 columns, followed by unnumbered back
+    matter. Unnumbered plates can be inserted in the body, each one shifts
+    the page difference of the pages after it.
+
+    Args:
+        path (str): The path of the PDF file to write.
+        body_pages (int): The number of body pages.
+        index_sections (tuple): The (columns, pages) of each index section.
+            The index lines are spread over the pages of the sections.
+        front_matter (int): The number of roman-numbered pages before the body.
+        back_matter (int): The number of unnumbered pages after the index.
+        first_page_number (int): The printed number of the first body page.
+        entries_per_column (int): The number of index lines that fit in a column.
+        page_labels (bool): Whether to also set the PDF page labels.
+        plates (tuple): The body page numbers followed by an unnumbered plate.
+        seed (int): The random seed, the same seed gives the same book.
+
+    Returns:
+        dict: The "page_count", the "index_pages" (1-based), the
+        "page_difference" between the PDF page and the printed page number of
+        the first body page, the "page_labels", the printed label of each
+        page or None if it has none, and the "entries", a list of (term,
+        occurrences) with the subtopics named "under parent: term" as in the
+        LLM prompt.
+    """
+    rng = random.Random(seed)
+    first_body, last_body = first_page_number, first_page_number + body_pages - 1
+    line_count = sum(columns * pages * entries_per_column for columns, pages in index_sections)
+    # About 1.2 lines per entry with the letter headers, subtopics and wrapped lines
+    entries = make_entries(rng, max(1, int(line_count / 1.25)), first_body, last_body)
+    lines = index_lines(entries, rng)
+
+    pdf = fitz.open()
+    labels = []  # Printed label of each page
+    label_rules = [{"startpage": 0, "prefix": "", "style": "r", "firstpagenum": 1}] if front_matter else []
+    for i in range(front_matter):
+        page = pdf.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        page.insert_text((72, 100), "Contents" if i == 0 else "Preface", fontsize=14)
+        insert_footer(page, roman(i + 1))
+        labels.append(roman(i + 1))
+    label_rules.append({"startpage": front_matter, "prefix": "", "style": "D", "firstpagenum": first_page_number})
+    for number in range(first_body, last_body + 1):
+        page = pdf.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        sentences = [
+            " ".join(random_word(rng) for _ in range(rng.randint(5, 8))).capitalize() + "." for _ in range(32)
+        ]
+        page.insert_text((72, 80), sentences, fontsize=BODY_FONT_SIZE, lineheight=2.1)
+        insert_footer(page, str(number))
+        labels.append(str(number))
+        if number in plates:
+            page = pdf.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+            page.insert_text((72, PAGE_HEIGHT / 2), f"Plate {len(labels) - front_matter}", fontsize=14)
+            labels.append(None)
+            label_rules.append({"startpage": pdf.page_count - 1, "prefix": "Plate", "style": "", "firstpagenum": 1})
+            label_rules.append({"startpage": pdf.page_count, "prefix": "", "style": "D", "firstpagenum": number + 1})
+
+    index_pages = []
+    position = 0
+    number = last_body
+    for columns, pages in index_sections:
+        column_width = (PAGE_WIDTH - 2 * MARGIN) / columns
+        for section_page in range(pages):
+            page = pdf.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+            number += 1
+            index_pages.append(pdf.page_count)
+            top = 90
+            if section_page == 0:
+                page.insert_text((MARGIN, 80), "Index", fontsize=16)
+                top = 120
+            for column in range(columns):
+                x = MARGIN + column * column_width
+                y = top
+                while position < len(lines) and y < PAGE_HEIGHT - 90:
+                    indent, text, _ = lines[position]
+                    wrapped = wrap_line(text, column_width - 15 - 10 * indent, INDEX_FONT_SIZE)
+                    if y + INDEX_LINE_HEIGHT * (len(wrapped) - 1) >= PAGE_HEIGHT - 90:
+                        break
+                    for j, part in enumerate(wrapped):
+                        page.insert_text((x + 10 * (indent + (j > 0)), y), part, fontsize=INDEX_FONT_SIZE)
+                        y += INDEX_LINE_HEIGHT
+                    position += 1
+            insert_footer(page, str(number))
+            labels.append(str(number))
+    for _ in range(back_matter):
+        page = pdf.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        page.insert_text((72, 100), "About the author", fontsize=14)
+        labels.append(None)
+
+    if page_labels:
+        pdf.set_page_labels(label_rules)
+    pdf.save(path)
+    page_count = pdf.page_count
+    pdf.close()
+
+    return {
+        "page_count": page_count,
+        "index_pages": index_pages,
+        "page_difference": front_matter - first_page_number + 1,
+        "page_labels": labels,
+        # Only the lines that fit in the index pages are in the book
+        "entries": [entry for _, _, entry in lines[:position] if entry is not None],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic book with an index.")
+    parser.add_argument("path")
+    parser.add_argument("--body-pages", type=int, default=300)
+    parser.add_argument("--index-pages", type=int, default=12)
+    parser.add_argument("--columns", type=int, default=2, choices=(1, 2, 3))
+    parser.add_argument("--front-matter", type=int, default=10)
+    parser.add_argument("--plates", type=int, nargs="*", default=[])
+    parser.add_argument("--page-labels", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    truth = make_book(
+        args.path, args.body_pages, ((args.columns, args.index_pages),), args.front_matter,
+        page_labels=args.page_labels, plates=tuple(args.plates), seed=args.seed,
+    )
+    print(json.dumps({key: value for key, value in truth.items() if key not in ("entries", "page_labels")}))
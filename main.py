@@ -1,12 +1,51 @@
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox, Toplevel
 import threading
-import fitz  # PyMuPDF
+import queue
+import time
+from bisect import bisect_right
 from src.document import Document
-from ctypes import windll
+from src.llm import LLMClient
+from src.index_search import IndexSearch
+from src.page_reader import PageReader
+from utils.virtual_list import VirtualList
+from utils.metrics import metrics
 import asyncio
+import os
+import re
+import sys
 import traceback
-windll.shcore.SetProcessDpiAwareness(1)
+if sys.platform == "win32":
+    from ctypes import windll
+    windll.shcore.SetProcessDpiAwareness(1)
+
+# The queue of UI updates is drained every UPDATE_INTERVAL_MS, for at most UPDATE_BUDGET seconds
+UPDATE_INTERVAL_MS = 30
+UPDATE_BUDGET = 0.01
+# Pages of the selected entry extracted in the background
+PREFETCH_PAGES = 32
+
+
+class PageRanges:
+    """The page numbers of a list of (start, end) occurrences, as a sequence, without expanding the ranges."""
+
+    def __init__(self, occurrences):
+        self.starts = []
+        self.offsets = []  # Position of the first page of each range
+        length = 0
+        for start, end in occurrences:
+            self.starts.append(start)
+            self.offsets.append(length)
+            length += max(0, end - start) + 1
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        i = bisect_right(self.offsets, position) - 1
+        return self.starts[i] + position - self.offsets[i]
+
 
 class PDFIndexApp:
     def __init__(self, root):
@@ -37,10 +76,18 @@ class PDFIndexApp:
         
         self.results_label = tk.Label(self.results_frame, text="Index Results:")
         self.results_label.pack(anchor="w")
+
+        # Search box: a term prefix, a misspelled term, or "p 312" for the terms of a page
+        self.search_text = tk.StringVar()
+        self.search_text.trace_add("write", self.filter_results)
+        self.search_entry = tk.Entry(self.results_frame, textvariable=self.search_text)
+        self.search_entry.pack(fill=tk.X, pady=5)
         
-        self.results_list = tk.Listbox(self.results_frame, height=15)
+        # Only the rows in view are created, see utils/virtual_list.py
+        self.results_list = VirtualList(
+            self.results_frame, self.result_count, self.result_text, command=self.display_index_pages, height=15
+        )
         self.results_list.pack(fill=tk.BOTH, expand=True)
-        self.results_list.bind("<<ListboxSelect>>", self.display_index_pages)
         
         # Page number selection
         self.page_number_frame = tk.Frame(root)
@@ -49,81 +96,226 @@ class PDFIndexApp:
         self.page_number_label = tk.Label(self.page_number_frame, text="Page Numbers:")
         self.page_number_label.pack(anchor="w")
         
-        self.page_number_list = tk.Listbox(self.page_number_frame, height=15)
+        self.page_numbers = PageRanges([])  # Pages of the selected entry
+        self.page_number_list = VirtualList(
+            self.page_number_frame, lambda: len(self.page_numbers), lambda row: str(self.page_numbers[row]),
+            command=self.display_page_text_popup, height=15,
+        )
         self.page_number_list.pack(fill=tk.BOTH, expand=True)
-        self.page_number_list.bind("<<ListboxSelect>>", self.display_page_text_popup)
         
         # Document instance
         self.document = None
-        self.index_results = []
+        self.page_reader = None  # Open handle and page text cache of the document, for the page popups
+        self.llm_client = LLMClient()  # Shared by the documents processed in this session, one at a time
+        self.processing = False  # Whether a document is being processed, set in the Tk thread
+        self.index_results = []  # Entries of the document, its IndexStore once processing starts
+        self.search = None  # IndexSearch over index_results
+        self.visible_results = None  # Positions of the listed entries when filtered, None for all
         self.selected_index = None
         self.page_difference = 0
+
+        # Widgets are only changed from the Tk thread: the worker threads post their updates here
+        self.updates = queue.Queue()
+        self.root.after(UPDATE_INTERVAL_MS, self.drain_updates)
+
+    def post(self, function, *args):
+        """Runs `function(*args)` in the Tk thread. Can be called from any thread."""
+        self.updates.put((function, args))
+
+    def drain_updates(self):
+        """
+        Runs the posted updates for at most UPDATE_BUDGET seconds, then lets Tk
+        handle events. An update that fails is reported in the log and the
+        following ones still run.
+        """
+        deadline = time.perf_counter() + UPDATE_BUDGET
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    function, args = self.updates.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    function(*args)
+                except Exception as e:
+                    print(traceback.format_exc())
+                    self.write_log(f"Error updating the window: {e}")
+        finally:
+            self.root.after(UPDATE_INTERVAL_MS, self.drain_updates)
         
     def select_file(self):
+        if self.processing:
+            # The LLM client and its rate limits serve one asyncio loop at a time
+            messagebox.showinfo("PDF Index Processor", "Wait for the current PDF to be processed.")
+            return
         file_path = filedialog.askopenfilename(filetypes=[("PDF files", "*.pdf")])
         if file_path:
             self.file_path.set(file_path)
             self.start_processing(file_path)
     
     def start_processing(self, file_path):
+        self.processing = True
         self.log("Processing started...")
+        self.progress.config(mode="indeterminate", value=0)
         self.progress.start()
         threading.Thread(target=self.process_pdf, args=(file_path,)).start()
     
     def process_pdf(self, file_path):
+        # Runs in a worker thread, the widgets are updated through self.post
         try:
-            self.document = Document(doc_type="pdf", path=file_path)
-            self.document.filter_index_pages()
-            self.log("Index pages found: " + ", ".join(map(str, self.document.index_pages)))
-            self.log("The page difference seems to be: " + str(self.document.page_difference))
+            document = Document(doc_type="pdf", path=file_path, llm_client=self.llm_client, stream_llm=True)
+            loaded = document.load_index()
+            if loaded:
+                # The saved index does not keep the page labels, they are located here rather than in the Tk thread
+                document.locate_page_labels()
+            self.post(self.show_document, document, PageReader(document))
+            if loaded:
+                # Processed before, the results were saved
+                self.log("Index pages found: " + ", ".join(map(str, document.index_pages)))
+                self.log("The page difference seems to be: " + str(document.page_difference))
+                self.post(self.update_results)
+                self.post(self.set_search, document, IndexSearch(document.original_index))
+                return
+            document.filter_index_pages()
+            self.log("Index pages found: " + ", ".join(map(str, document.index_pages)))
+            self.log("The page difference seems to be: " + str(document.page_difference))
             self.log("Parsing index pages...")
-            asyncio.run(self.document.parse_index_pages())
-            self.index_results = self.document.original_index
-            self.update_results()
+            asyncio.run(self.parse_document(document))
+            document.save_index()
+            self.post(self.set_search, document, IndexSearch(document.original_index))
+            self.log(f"Loaded {len(document.original_index)} indices.")
         except Exception as e:
             self.log(f"Error: {e}")
             self.log(f"Traceback: {traceback.format_exc()}")
         finally:
-            self.progress.stop()
+            self.post(self.processing_done)
             self.log("Processing complete.")
-    
+            if metrics.enabled:
+                metrics.write_reports(os.environ.get("PDF_INDEX_METRICS", "metrics.json"))
+
+    def processing_done(self):
+        self.progress.stop()
+        self.processing = False
+        # No entries are added anymore, the search can be built from the store
+        self.search_entry.config(state="normal")
+
+    def show_document(self, document, page_reader):
+        """
+        Replaces the results of the previous document by the entries of
+        `document`, then closes the previous document, which the rows and
+        popups no longer read from.
+        """
+        previous = self.document, self.page_reader
+        self.document = document
+        self.page_reader = page_reader
+        self.index_results = document.original_index
+        self.search = None
+        self.visible_results = None
+        self.selected_index = None
+        self.page_numbers = PageRanges([])
+        self.search_text.set("")  # Resets the results list, see filter_results
+        # The worker thread adds entries to the store until its search is built, see set_search
+        self.search_entry.config(state="disabled")
+        self.results_list.reset()
+        self.page_number_list.reset()
+        if previous[0] is not None:
+            # Closing joins the prefetch thread of the page reader, so it is not done in the Tk thread
+            threading.Thread(target=self.close_document, args=previous, daemon=True).start()
+
+    def set_search(self, document, search):
+        """Uses the search built by the worker thread once the entries of `document` are complete."""
+        if document is self.document:
+            self.search = search
+            self.search_entry.config(state="normal")
+
+    def close_document(self, document, page_reader):
+        page_reader.close()
+        # Unmaps the saved index of the document
+        document.close()
+
+    async def parse_document(self, document):
+        # The client session belongs to the loop of this asyncio.run call,
+        # so it is closed before the loop ends
+        async with self.llm_client:
+            async for done, total, entries in document.stream_index_pages():
+                self.post(self.add_results, entries)
+                self.post(self.update_progress, done, total)
+
+    def add_results(self, entries):
+        # The entries are already in self.index_results, the document stores them
+        if self.visible_results is not None:
+            return
+        self.results_list.refresh()
+
+    def update_progress(self, done, total):
+        if str(self.progress.cget("mode")) != "determinate":
+            self.progress.stop()
+            self.progress.config(mode="determinate", maximum=total)
+        self.progress.config(value=done)
+        self.write_log(f"Parsed chunk {done}/{total}.")
+
     def update_results(self):
-        self.results_list.delete(0, tk.END)
-        for idx, index in enumerate(self.index_results):
-            self.results_list.insert(tk.END, f"{index.term} ({len(index.occurrences)} occurrences)")
-        self.log(f"Loaded {len(self.index_results)} indices.")
-    
-    def display_index_pages(self, event):
-        selection = self.results_list.curselection()
-        if not selection:
+        self.results_list.reset()
+        self.write_log(f"Loaded {len(self.index_results)} indices.")
+
+    def result_count(self):
+        return len(self.index_results if self.visible_results is None else self.visible_results)
+
+    def result_text(self, row):
+        index = self.index_results[row if self.visible_results is None else self.visible_results[row]]
+        return f"{index.term} ({len(index.occurrences)} occurrences)"
+
+    def search_results(self, query):
+        """
+        Returns the positions of the entries matching the search box query.
+        The search box is disabled while the entries are parsed, so the
+        store does not change while the search is built from it.
+        """
+        if self.search is None or self.search.size != len(self.index_results):
+            self.search = IndexSearch(self.index_results)
+        page = re.fullmatch(r"p(?:age)?[\s:.]*(\d+)", query, re.IGNORECASE)
+        if page:
+            return self.search.entries_for_page(int(page.group(1)))
+        positions = self.search.prefix(query, limit=1000)
+        if not positions and len(query) >= 3:
+            # Maybe a misspelled or OCR-mangled term
+            positions = self.search.fuzzy(query, max_distance=1 if len(query) < 6 else 2, prefix=True)
+        return positions
+
+    def filter_results(self, *args):
+        query = self.search_text.get().strip()
+        if not query:
+            self.visible_results = None
+        elif self.document is None:
             return
-        selected_index = selection[0]
+        else:
+            self.visible_results = self.search_results(query)
+        self.results_list.reset()
+    
+    def display_index_pages(self, row):
+        selected_index = row if self.visible_results is None else self.visible_results[row]
         self.selected_index = self.index_results[selected_index]
         self.update_page_numbers()
     
     def update_page_numbers(self):
-        self.page_number_list.delete(0, tk.END)
-        if self.selected_index:
-            for start, end in self.selected_index.occurrences:
-                for page_number in range(start, end + 1):
-                    self.page_number_list.insert(tk.END, page_number)
+        self.page_numbers = PageRanges(self.selected_index.occurrences if self.selected_index else [])
+        self.page_number_list.reset()
+        # The popup of these pages is likely next
+        self.page_reader.prefetch(
+            self.document.pdf_page(self.page_numbers[row])
+            for row in range(min(len(self.page_numbers), PREFETCH_PAGES))
+        )
     
-    def display_page_text_popup(self, event):
-        selection = self.page_number_list.curselection()
-        if not selection:
-            return
-        selected_page = int(self.page_number_list.get(selection[0]))
-        self.load_page_text_popup(selected_page)
+    def display_page_text_popup(self, row):
+        self.load_page_text_popup(self.page_numbers[row])
     
     def load_page_text_popup(self, page_number):
-        with fitz.open(self.file_path.get()) as pdf:
-            page = pdf[page_number + self.document.page_difference - 1]  # Pages are 0-indexed in PyMuPDF
-            text = page.get_text("text")
-            self.show_text_popup(text)
+        text = self.page_reader.text(self.document.pdf_page(page_number))
+        self.show_text_popup(page_number, text)
     
-    def show_text_popup(self, text):
+    def show_text_popup(self, page_number, text):
         popup = Toplevel(self.root)
-        popup.title(f"Page {int(self.page_number_list.get(self.page_number_list.curselection()))} Text")
+        popup.title(f"Page {page_number} Text")
         popup.geometry("2200x1500")
         
         text_label = tk.Label(popup, text="Page Text:")
@@ -138,6 +330,10 @@ class PDFIndexApp:
         close_button.pack(pady=10)
     
     def log(self, message):
+        """Adds a line to the log. Can be called from any thread."""
+        self.post(self.write_log, message)
+
+    def write_log(self, message):
         self.log_text.config(state="normal")
         self.log_text.insert(tk.END, message + "\n")
         self.log_text.see(tk.END)
@@ -116,7 +116,8 @@ def extract_index(pdf_path):
         
         return terms
 # Example usage
-pdf_path = './resource/pdf/test.pdf'
-index_terms = extract_index(pdf_path)
-# for term, pages in index_terms.items():
-#     print(f"{term}: {pages}")
\ No newline at end of file
+if __name__ == "__main__":
+    pdf_path = './resource/pdf/test.pdf'
+    index_terms = extract_index(pdf_path)
+    # for term, pages in index_terms.items():
+    #     print(f"{term}: {pages}")
\ No newline at end of file
@@ -0,0 +1,132 @@
+import re
+
+# Marks the first line of a chunk that only repeats the parent term of the
+# subtopics that follow it. The prompt tells the LLM not to output it.
+CONTEXT_PREFIX = "[continued]"
+
+CHARS_PER_TOKEN = 4
+# Tokens of JSON around each output entry: {"t": "", "o": [[, ]]},
+ENTRY_OUTPUT_OVERHEAD = 10
+
+
+def estimate_tokens(text):
+    """Roughly estimates the number of tokens of a text (about 4 characters per token)."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_output_tokens(line, parent=None):
+    """
+    Roughly estimates the output tokens of the JSON entry of an index line.
+
+    Page numbers are written twice (as [start, end]) and subtopics repeat their
+    parent term ("under parent: term").
+    """
+    tokens = ENTRY_OUTPUT_OVERHEAD + 2 * estimate_tokens(line)
+    if parent is not None:
+        tokens += estimate_tokens(parent) + 2
+    return tokens
+
+
+def is_top_level(line):
+    """Whether a line starts a top-level term, i.e. a place where a chunk can be cut."""
+    line = line.strip()
+    return bool(line) and line[0].isupper()
+
+
+def is_parent(line):
+    """Whether a line is a parent term: it ends with a colon or has no page numbers."""
+    line = line.strip()
+    return is_top_level(line) and (line.endswith(":") or not re.search(r"\d$", line))
+
+
+def chunk_lines(lines, max_input_tokens, max_output_tokens, boundaries=()):
+    """
+    Packs index lines into chunks that fit a token budget.
+
+    Chunks are cut at parent-term boundaries: before a top-level term, or at
+    one of the given `boundaries`. When a single parent term does not fit in
+    one chunk, it is cut between its subtopics and the next chunk starts with
+    the parent term as context, prefixed by CONTEXT_PREFIX.
+
+    Args:
+        lines (list[str]): The index lines.
+        max_input_tokens (int): The input token budget of a chunk, without the prompt.
+        max_output_tokens (int): The output token budget of a chunk.
+        boundaries (iterable[int]): Positions of additional lines that can start a chunk.
+
+    Returns:
+        list[list[str]]: The lines of each chunk.
+    """
+    boundaries = set(boundaries)
+    chunks = []
+    start = 0
+    context = None  # Parent line repeated at the start of the current chunk
+    input_tokens = output_tokens = 0
+    last_boundary = None  # Last position in the current chunk where it can be cut
+    parent = None  # Position of the parent term of the current line, if any
+    parents = []  # Parent position of every line
+
+    def costs(position):
+        parent_line = lines[parents[position]] if parents[position] is not None else None
+        return estimate_tokens(lines[position]) + 1, estimate_output_tokens(lines[position], parent_line)
+
+    for i, line in enumerate(lines):
+        boundary = i in boundaries or is_top_level(line)
+        if boundary:
+            parent = i if is_parent(line) else None
+            if i > start:
+                last_boundary = i
+        parents.append(parent if parent != i else None)
+        line_input, line_output = costs(i)
+        if i > start and (input_tokens + line_input > max_input_tokens or output_tokens + line_output > max_output_tokens):
+            cut = last_boundary if last_boundary is not None and last_boundary > start else i
+            chunks.append(([context] if context else []) + lines[start:cut])
+            start = cut
+            context = None
+            if cut not in boundaries and not is_top_level(lines[cut]) and parents[cut] is not None:
+                context = f"{CONTEXT_PREFIX} {lines[parents[cut]].strip()}"
+            input_tokens = estimate_tokens(context) + 1 if context else 0
+            output_tokens = 0
+            for position in range(start, i):
+                position_input, position_output = costs(position)
+                input_tokens += position_input
+                output_tokens += position_output
+            last_boundary = i if boundary and i > start else None
+        input_tokens += line_input
+        output_tokens += line_output
+    if start < len(lines):
+        chunks.append(([context] if context else []) + lines[start:])
+    return chunks
+
+
+def split_chunk(lines):
+    """
+    Splits the lines of a chunk in about two halves, for a chunk whose output
+    did not fit in the output token limit. The halves are cut at a parent-term
+    boundary when possible, like `chunk_lines`, and the context line of the
+    chunk is repeated in the second half if its subtopics continue there.
+
+    Returns:
+        list[list[str]]: The lines of each part, or only the chunk if it has
+        a single index line.
+    """
+    lines = [line for line in lines if line.strip()]
+    context = lines[0] if lines and lines[0].startswith(CONTEXT_PREFIX) else None
+    body = lines[1:] if context else lines
+    if len(body) < 2:
+        return [lines]
+    if context:
+        # Split with the parent term of the context as the first line, so the
+        # second half gets its own context line
+        body = [context[len(CONTEXT_PREFIX):].strip()] + body
+    input_tokens = sum(estimate_tokens(line) + 1 for line in body)
+    # Half of the lines, plus a repeated context line
+    context_tokens = estimate_tokens(context) + 1 if context else 0
+    parts = chunk_lines(body, (input_tokens + 1) // 2 + context_tokens, float("inf"))
+    if len(parts) == 1:
+        # Short subtopics, where the context line outweighs the lines
+        parts = chunk_lines(body, (input_tokens + 1) // 2, float("inf"))
+    if context:
+        parts[0][0] = context
+    # A part left with only a context line has nothing to parse
+    return [part for part in parts if len(part) > 1 or not part[0].startswith(CONTEXT_PREFIX)]
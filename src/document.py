@@ -1,47 +1,148 @@
 import fitz
-import re
 from utils.analyze_bboxes import is_two_vertical_blocks
-from src.llm_index_parse import llm_parse_index
-import json
+from utils.multi_column import column_text
+from src.llm_index_parse import llm_parse_index, llm_stream_parse_index
+from src.local_index_parse import split_index_text
+from src.chunker import chunk_lines, split_chunk, estimate_tokens, CONTEXT_PREFIX
+from src.llm import TruncatedResponse, StreamInterrupted
+from src.llm_backends import make_backend
+from src.page_scan import scan_pages, locate_index_pages, page_offsets
+from src.page_offsets import PageLabels, page_labels
+from src.page_classifier import feature_matrix, classify_pages
+from src.page_cache import PageCache, page_digest, cache_dir_for
+from src.llm_cache import LLMCache, USE, BYPASS
+import sqlite3
 from collections import Counter
 import asyncio
 import time
 import json_repair
+from src.index import Index, IndexStore
+from src.index_file import MappedIndexStore, pdf_digest, write_index_file
+from src.json_stream import JSONArrayStream
+from src.prompt import PromptStats, RequestPacker, compact_text, strip_running_lines
+import os
+from utils.metrics import metrics
 
-# TODO: Put this in the utils file
-class RateLimiter:
-    def __init__(self, max_calls, period):
-        self.max_calls = max_calls
-        self.period = period
-        self.calls = []
-    
-    async def acquire(self):
-        while len(self.calls) >= self.max_calls:
-            await asyncio.sleep(self.period - (time.time() - self.calls[0]))
-            self.calls = [call for call in self.calls if time.time() - call < self.period]
-        self.calls.append(time.time())
-
-class Index:
-    def __init__(self, term, occurrences_list):
-        self.term = term
-        self.occurrences = occurrences_list  # List of tuples (start, end)
+# Times a chunk with a truncated response is split, at most 2 ** MAX_SPLIT_DEPTH parts
+MAX_SPLIT_DEPTH = 4
 
 
 class Document:
-    def __init__(self, doc_type, path):
+    def __init__(self, doc_type, path, scan_workers=1, cache_dir=None, use_cache=True, llm_cache_mode=USE,
+                 llm_client=None, hybrid_parse=True, max_input_tokens=6000, max_output_tokens=6000,
+                 locate_mode="backward", classifier_thresholds=None, column_aware=True,
+                 llm_backend="gemini", llm_semaphore=None, stream_llm=False, pack_requests=True, llm_packer=None):
         if doc_type not in ["pdf", "epub"]:
             raise ValueError("Document type must be either 'pdf' or 'epub'")
         self.doc_type = doc_type
         self.path = path
-        self.original_index = []  # List of Index instances
+        self.original_index = IndexStore()  # Parsed entries, read as Index-like views
         self.potential_index_pages = []  # List of page numbers
         self.index_pages = []  # List of page numbers
         self.page_number_difference_list = []
         self.page_difference = 0
+        self.page_labels = None  # Printed page numbers, see src/page_offsets.py
         self.index_page_text = ""
+        self.failed_chunks = 0  # Chunks without a usable LLM response
+        self.prompt_stats = PromptStats()  # Tokens saved on the LLM prompts, see src/prompt.py
+        self.first_entry_seconds = None  # Time from the start of the last stream_index to its first entry
+        self.scan_workers = scan_workers  # Worker processes for the page scan, None for one per CPU
+        self.locate_mode = locate_mode  # "backward" or "full", see filter_index_pages
+        self.classifier_thresholds = classifier_thresholds  # Overrides of page_classifier.DEFAULT_THRESHOLDS
+        self.page_digests = {}  # Content digest of the scanned pages, by page number
+        self.page_cache = None
+        self.cache_dir = None  # Directory of the saved index, None when caching is disabled
+        self.file_digest = None  # Digest of the PDF file, see index_file.pdf_digest
+        self.llm_cache = None  # Cache of LLM responses, see src/llm_cache.py
+        self.llm_client = llm_client  # Shared LLMClient, None to use one per parse_index call
+        self.llm_backend = llm_backend  # Backend of the per-call client, see src/llm_backends.py
+        self.llm_semaphore = llm_semaphore  # Limit of concurrent LLM calls shared with other documents
+        self.pack_requests = pack_requests  # Pack the small chunks into shared requests, see RequestPacker
+        self.llm_packer = llm_packer  # Shared RequestPacker, None to use one per stream_index call
+        self.stream_llm = stream_llm  # Decode the entries while the LLM generates them, see stream_chunk
+        self.hybrid_parse = hybrid_parse  # Parse clean index lines locally, only send the rest to the LLM
+        self.column_aware = column_aware  # Extract the index pages column by column, see utils/multi_column.py
+        # Token budget of each LLM chunk, see src/chunker.py
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        if use_cache:
+            self.cache_dir = cache_dir or cache_dir_for(path)
+            try:
+                self.page_cache = PageCache.for_pdf(path, cache_dir)
+                if llm_cache_mode != BYPASS:
+                    self.llm_cache = LLMCache.for_directory(
+                        cache_dir or cache_dir_for(path), mode=llm_cache_mode
+                    )
+            except (OSError, sqlite3.Error) as e:
+                print(f"Cache disabled: {e}")
+
+    def close(self):
+        """Closes the caches of the document, and its saved index if it was loaded."""
+        for cache in (self.page_cache, self.llm_cache):
+            if cache is not None:
+                cache.close()
+        self.page_cache = self.llm_cache = None
+        if isinstance(self.original_index, MappedIndexStore):
+            self.original_index.close()
+            self.original_index = IndexStore()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def index_file_path(self):
+        """Returns the path of the saved index of the document, in the cache directory."""
+        if self.file_digest is None:
+            self.file_digest = pdf_digest(self.path)
+        return os.path.join(self.cache_dir, f"index-{self.file_digest[:32]}.bin")
+
+    def load_index(self):
+        """
+        Loads the index pages, the page difference and the entries saved by
+        `save_index`, if the PDF did not change since. The entries are read
+        from the memory-mapped file, see `MappedIndexStore`.
+
+        Returns:
+            bool: Whether a saved index was loaded.
+        """
+        if self.cache_dir is None:
+            return False
+        try:
+            store = MappedIndexStore.open(self.index_file_path(), self.file_digest)
+        except OSError as e:
+            print(f"Saved index not loaded: {e}")
+            return False
+        if store is None:
+            return False
+        self.original_index = store
+        self.index_pages = store.index_pages
+        self.page_difference = store.page_difference
+        return True
+
+    def save_index(self):
+        """
+        Saves the index pages, the page difference and the parsed entries to
+        the cache directory, for `load_index`. Call it once the whole index is
+        parsed.
+        """
+        if self.cache_dir is None or isinstance(self.original_index, MappedIndexStore):
+            # Caching is disabled, or the entries already come from the saved index
+            return
+        if self.failed_chunks:
+            print(f"Index not saved: {self.failed_chunks} chunks failed to parse.")
+            return
+        try:
+            write_index_file(
+                self.index_file_path(), self.file_digest, self.original_index, self.index_pages,
+                self.page_difference,
+            )
+        except OSError as e:
+            print(f"Index not saved: {e}")
 
     def add_index(self, term, occurrences):
-        self.original_index.append(Index(term, occurrences))
+        self.original_index.append(term, occurrences)
 
     def add_index_page(self, page_number):
         self.index_pages.append(page_number)
@@ -49,137 +150,469 @@ class Document:
     def add_potential_index_page(self, page_number):
         self.potential_index_pages.append(page_number)
     
-    def filter_index_pages(self):
-        if (len(self.index_pages) > 0):
-            return
-        with fitz.open(self.path) as pdf:
-            for page_number, page in enumerate(pdf, start=1):
-                text = page.get_text("text")
-                # If the text starts with a number or ends with a number, it's likely the page number
-                if (re.match(r'^\d', text)):
-                    current_internal_page_number = re.match(r'\d+', text).group(0)
-                    self.page_number_difference_list.append(page_number - int(current_internal_page_number))
-                match = re.search(r'\d+[\s|\n]*$', text)
-                if match:
-                    self.page_number_difference_list.append(page_number - int(match.group(0)))
-                
-                # An index page should have at least 10 numbers
-                # Find the number of matches using a regular expression \d+
-                match_count = len(re.findall(r"\d+", text))
-                if match_count <= 10:
-                    continue
-                # Simple regex to match index entries
-                pattern = r"^[^,]+,\s*\d+"
-                matches = re.findall(pattern, text, re.MULTILINE)
-                if ("index" in text[:100].lower()):
-                    self.add_index_page(page_number)
-                    continue
-                if (len(matches) < 10):
-                    continue
-                self.add_index_page(page_number)
-        if self.page_number_difference_list:
+    def filter_index_pages(self, workers=None, mode=None):
+        """
+        Finds the index pages and the page number difference.
+
+        Args:
+            workers (int): Worker processes of the full scan, defaults to `scan_workers`.
+            mode (str): "backward" to search the index from the end of the book
+                and fall back to the full scan when it is not found with
+                confidence, or "full" to scan every page. Defaults to `locate_mode`.
+        """
+        with metrics.timer("stage_seconds", stage="filter_index_pages"):
+            if (len(self.index_pages) > 0):
+                return
+            if workers is None:
+                workers = self.scan_workers
+            if (mode or self.locate_mode) == "backward":
+                with metrics.timer("stage_seconds", stage="locate_index_pages"):
+                    located = locate_index_pages(self.path, self.page_cache, thresholds=self.classifier_thresholds)
+                if located:
+                    self.index_pages, features = located
+                    self.page_digests.update((page["page"], page["digest"]) for page in features)
+                    for page in features:
+                        self.page_number_difference_list.extend(page_offsets(page))
+                    self.update_page_difference()
+                    return
+                print("Index not located from the end of the book, scanning every page.")
+            with metrics.timer("stage_seconds", stage="scan_pages"):
+                features = scan_pages(self.path, workers, self.page_cache)
+            self.page_digests.update((page["page"], page["digest"]) for page in features)
+            for page in features:
+                self.page_number_difference_list.extend(page_offsets(page))
+            self.update_page_difference()
+            # Keep the longest consecutive sequence of index pages, from its page with the "index" header
+            self.potential_index_pages, self.index_pages = classify_pages(
+                feature_matrix(features), [page["page"] for page in features], self.classifier_thresholds
+            )
+            if not self.potential_index_pages:
+                print("No index pages found.")
+
+    def locate_page_labels(self):
+        """Reads the page labels of the PDF, or estimates them from a sample of its pages."""
+        try:
+            with metrics.timer("stage_seconds", stage="page_labels"), fitz.open(self.path) as pdf:
+                self.page_labels = page_labels(pdf)
+        except Exception as e:
+            print(f"Page labels not found: {e}")
+            self.page_labels = PageLabels([], 0)
+
+    def update_page_difference(self):
+        """
+        Sets `page_difference` to the offset of the body in the page labels
+        if enough sampled pages agree on it, see `PageLabels.is_reliable`, or
+        else to the most common offset of the scanned pages.
+        """
+        self.locate_page_labels()
+        difference = self.page_labels.difference()
+        if self.page_labels.is_reliable():
+            self.page_difference = difference
+        elif self.page_number_difference_list:
             self.page_difference = Counter(self.page_number_difference_list).most_common(1)[0][0]
-        # Only keep the longest consecutive sequence of index pages
-        if self.index_pages:
-            longest_sequence = [self.index_pages[0]]
-            current_sequence = [self.index_pages[0]]
-            for i in range(1, len(self.index_pages)):
-                if self.index_pages[i] == self.index_pages[i - 1] + 1:
-                    current_sequence.append(self.index_pages[i])
-                else:
-                    if len(current_sequence) > len(longest_sequence):
-                        longest_sequence = current_sequence
-                    current_sequence = [self.index_pages[i]]
-            if len(current_sequence) > len(longest_sequence):
-                longest_sequence = current_sequence
-            with fitz.open(self.path) as pdf:
-                # The begin of the index sequence should contain the word
-                # "index" in the first 10 lines
-                while (True):
-                    if (len(longest_sequence) == 0):
-                        break
-                    page = pdf.load_page(longest_sequence[0] - 1)
-                    text = page.get_text("text")[:100]
-                    if "index" in text.lower():
-                        break
-                    longest_sequence = longest_sequence[1:]
-            self.index_pages = longest_sequence
-
-        else:
-            print("No index pages found.")
+        elif difference is not None:
+            # Only a few sampled pages agree on it, but no other offset was found
+            self.page_difference = difference
 
-    async def extract_page_text(self, pdf, page_number):
+    def pdf_page(self, page_number):
+        """
+        Returns the PDF page (1-based) of a printed page number, exact even
+        when the difference changes between the sections of the book. Uses
+        `page_difference` until reliable page labels are located, see
+        `locate_page_labels`, so it never reads the PDF.
+        """
+        if self.page_labels is None or not self.page_labels.is_reliable():
+            return page_number + self.page_difference
+        return self.page_labels.pdf_page(page_number)
+
+    def get_page_text(self, pdf, page_number, column_aware=False):
+        """
+        Returns the text of a page (1-based), reading through the page cache.
+
+        With `column_aware`, the text is in column reading order (see
+        `column_text`) instead of the PDF content order.
+        """
         page = pdf.load_page(page_number - 1)
-        return page.get_text("text")
+        extract, kind = (column_text, "columns:v1") if column_aware else (lambda page: page.get_text("text"), "text")
+        stage = "column_text" if column_aware else "page_text"
+        if self.page_cache is None:
+            with metrics.timer("stage_seconds", stage=stage):
+                return extract(page)
+        digest = self.page_digests.get(page_number) or page_digest(page)
+        text = self.page_cache.get(digest, kind)
+        metrics.count("page_text_total", stage=stage, cache="miss" if text is None else "hit")
+        if text is None:
+            with metrics.timer("stage_seconds", stage=stage):
+                text = extract(page)
+            self.page_cache.put(digest, kind, text)
+        return text
 
-    async def parse_index_pages(self):
+    async def extract_page_text(self, pdf, page_number):
+        return self.get_page_text(pdf, page_number, self.column_aware)
+
+    async def extract_index_pages_text(self):
         self.index_page_text = ""
-        with fitz.open(self.path) as pdf:
+        with metrics.timer("stage_seconds", stage="extract_index_pages_text"), fitz.open(self.path) as pdf:
             tasks = [self.extract_page_text(pdf, page_number) for page_number in self.index_pages]
 
             # Run all tasks concurrently
             extracted_texts = await asyncio.gather(*tasks)
-            self.index_page_text = "".join(extracted_texts)
+            # Drop the running headers and footers and the extra whitespace, they only cost LLM tokens
+            pages, running_lines = strip_running_lines(extracted_texts)
+            self.index_page_text = compact_text("\n".join(pages))
+        self.prompt_stats.running_lines += len(running_lines)
+        self.prompt_stats.save("running_lines", sum(estimate_tokens(line) + 1 for line in running_lines))
+        self.prompt_stats.save("whitespace", estimate_tokens("\n".join(pages)) - estimate_tokens(self.index_page_text))
+        return self.index_page_text
 
-        # Call the asynchronous parse_index method
-        await self.parse_index(self.index_page_text)
+    async def parse_index_pages(self):
+        with metrics.timer("stage_seconds", stage="parse_index_pages"):
+            await self.extract_index_pages_text()
+
+            # Call the asynchronous parse_index method
+            await self.parse_index(self.index_page_text)
+
+    async def stream_index_pages(self, ordered=True):
+        """Extracts the text of the index pages and streams its entries, see `stream_index`."""
+        await self.extract_index_pages_text()
+        async for batch in self.stream_index(self.index_page_text, ordered):
+            yield batch
 
     async def parse_index(self, text):
-        chunks = list(self.split_text_into_chunks(text))
-        print("Number of chunks:", len(chunks))
-        
-        semaphore = asyncio.Semaphore(10)  # Limit to 10 concurrent tasks
-        rate_limiter = RateLimiter(15, 60)
+        async for _ in self.stream_index(text):
+            pass
 
-        async def sem_process_chunk(chunk):
-            async with semaphore:
-                await rate_limiter.acquire()
-                return await self.process_chunk(chunk)
-
-        tasks = [sem_process_chunk(chunk) for chunk in chunks]
-        results = await asyncio.gather(*tasks)
-        
-        # Process results in order
-        for result in results:
-            for entry in result:
-                self.add_index(entry.term, entry.occurrences)
-    
-    def split_text_into_chunks(self, text, lines_per_chunk=120):
-        lines = text.splitlines()
-        for i in range(0, len(lines), lines_per_chunk):
-            yield "\n".join(lines[i:i + lines_per_chunk])
+    async def stream_index(self, text, ordered=True):
+        """
+        Parses the index text chunk by chunk and yields the entries of each
+        chunk as soon as they are available. With `stream_llm`, the entries
+        of a chunk are yielded in parts, as the LLM generates them.
 
-    async def process_chunk(self, text):
-        index = await llm_parse_index(text)
-        results = []
-        if index.startswith("```json"):
-            index = index[len("```json"):].strip()
-        if index.endswith("```"):
-            index = index[:-len("```")].strip()
-        try:
-            parsed_index = json_repair.loads(index)
-            for entry in parsed_index:
-                term = entry["t"]
-                occurrences = entry["o"]
-                occurrences_list = []
-                for occurrence in occurrences:
+        The entries are also added to `original_index`, in the order they are
+        yielded.
+
+        Args:
+            text (str): The text of the index pages.
+            ordered (bool): Whether to yield the chunks in their order in the
+                text. Otherwise they are yielded as they complete.
+
+        Yields:
+            tuple: The number of chunks done, the total number of chunks and
+            the list of Index entries of the chunk, or of the part of a chunk.
+        """
+        start = time.perf_counter()
+        self.first_entry_seconds = None
+        chunks = self.plan_chunks(text)
+        llm_chunks = sum(isinstance(chunk, str) for chunk in chunks)
+        print("Number of chunks:", llm_chunks)
+        metrics.count("chunks_total", llm_chunks, kind="llm")
+        metrics.count("chunks_total", len(chunks) - llm_chunks, kind="local")
+
+        semaphore = self.llm_semaphore or asyncio.Semaphore(10)  # Limit to 10 concurrent tasks
+        client = self.llm_client or make_backend(self.llm_backend)
+        packer = self.llm_packer
+        if packer is None and self.pack_requests:
+            packer = RequestPacker(client, self.max_input_tokens, self.max_output_tokens)
+
+        # Entries of the chunks as (chunk number, entries, whether the chunk is done)
+        updates = asyncio.Queue()
+
+        async def sem_process_chunk(chunk_number, chunk):
+            if not isinstance(chunk, str):
+                # Entries that were parsed locally
+                updates.put_nowait((chunk_number, chunk, True))
+                return
+            async with semaphore:
+                with metrics.timer("stage_seconds", stage="process_chunk"):
                     try:
-                        if (len(occurrence) == 1):
-                            start = occurrence[0]
-                            end = occurrence[0]
+                        if self.stream_llm:
+                            emit = lambda entries: updates.put_nowait((chunk_number, entries, False))
+                            await self.stream_chunk(chunk, emit, client, packer=packer)
+                            result = []
                         else:
-                            start = occurrence[0]
-                            end = occurrence[1]
-                        occurrences_list.append((start, end))
+                            result = await self.process_chunk(chunk, client, packer=packer)
                     except Exception as e:
-                        print(f"Error parsing occurrence: {e}, occurrence: {occurrence}")
-                results.append(Index(term, occurrences_list))
-        except json.JSONDecodeError as e:
-            print(index)
-            print(f"JSONDecodeError: {e}")
+                        # Only this chunk is lost, the parsed ones are kept and the responses are cached
+                        print(f"Error parsing a chunk: {type(e).__name__}: {e}")
+                        self.failed_chunks += 1
+                        metrics.count("failed_chunks_total", reason="error")
+                        result = []
+            updates.put_nowait((chunk_number, result, True))
+
+        tasks = [asyncio.ensure_future(sem_process_chunk(i, chunk)) for i, chunk in enumerate(chunks)]
+        pending = {}  # Entries of the chunks waiting for the previous ones, in ordered mode
+        finished = set()  # Chunks of `pending` that are done
+        next_chunk = 0
+        done = 0
+        try:
+            while done < len(chunks):
+                chunk_number, result, last = await updates.get()
+                if not ordered:
+                    ready = [(result, last)]
+                else:
+                    pending.setdefault(chunk_number, []).extend(result)
+                    if last:
+                        finished.add(chunk_number)
+                    ready = []
+                    # The entries of the current chunk are ready as soon as they arrive
+                    while next_chunk in pending:
+                        last = next_chunk in finished
+                        ready.append((pending.pop(next_chunk), last))
+                        if not last:
+                            break
+                        finished.discard(next_chunk)
+                        next_chunk += 1
+                for result, last in ready:
+                    if not result and not last:
+                        continue
+                    for entry in result:
+                        self.add_index(entry.term, entry.occurrences)
+                    metrics.count("entries_total", len(result))
+                    if result and self.first_entry_seconds is None:
+                        self.first_entry_seconds = time.perf_counter() - start
+                        metrics.observe("first_entry_seconds", self.first_entry_seconds)
+                    done += last
+                    yield done, len(chunks), result
+            if packer is not None and packer is not self.llm_packer:
+                self.prompt_stats.add(packer.stats)
+            print(self.prompt_stats.summary())
+        finally:
+            # Stop the remaining chunks if the consumer stops early or a chunk failed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Only close the client created for this call, an injected one is reused
+            if client is not self.llm_client:
+                await client.close()
+            metrics.observe("stage_seconds", time.perf_counter() - start, stage="parse_index")
 
+    def plan_chunks(self, text):
+        """
+        Splits the index text into the chunks to parse, in text order.
+
+        In hybrid mode, the clean lines are parsed locally and only the groups
+        of ambiguous lines are packed into chunks for the LLM.
+
+        Returns:
+            list: The chunks, either a str of text for the LLM or a list of
+            Index entries that are already parsed.
+        """
+        if not self.hybrid_parse:
+            return list(self.split_text_into_chunks(text))
+        segments = split_index_text(text)
+        # Pack the lines of all the ambiguous groups together, each group can start a chunk
+        llm_lines = []
+        group_starts = []
+        for is_local, payload in segments:
+            if not is_local:
+                group_starts.append(len(llm_lines))
+                llm_lines.extend(payload)
+        llm_chunks = chunk_lines(llm_lines, self.max_input_tokens, self.max_output_tokens, group_starts)
+
+        # Place each LLM chunk with the group of its first line
+        chunks = []
+        next_chunk = 0
+        first_line = 0  # Position in llm_lines of the first line of the next LLM chunk
+        group = 0
+        for is_local, payload in segments:
+            if is_local:
+                chunks.append([Index(term, occurrences) for term, occurrences in payload])
+                continue
+            group_end = group_starts[group] + len(payload)
+            while next_chunk < len(llm_chunks) and first_line < group_end:
+                chunk = llm_chunks[next_chunk]
+                chunks.append("\n".join(chunk))
+                first_line += len(chunk) - (chunk[0].startswith(CONTEXT_PREFIX))
+                next_chunk += 1
+            group += 1
+        print("Entries parsed locally:", sum(len(chunk) for chunk in chunks if not isinstance(chunk, str)))
+        return chunks
+
+    def split_text_into_chunks(self, text):
+        lines = [line for line in text.splitlines() if line.strip()]
+        for chunk in chunk_lines(lines, self.max_input_tokens, self.max_output_tokens):
+            yield "\n".join(chunk)
+
+    async def process_chunk(self, text, client=None, depth=0, packer=None):
+        """
+        Parses a chunk of index text with the LLM.
+
+        A small chunk is packed with others by `packer` if given, see
+        `RequestPacker`. The first JSON list of the response is decoded, the
+        text around it is ignored. When the response is cut at the output
+        token limit (`TruncatedResponse`), the chunk is split
+        in two (see `split_chunk`) and each part is parsed again, up to
+        MAX_SPLIT_DEPTH times. A chunk that still does not fit, or gets no
+        response, counts in `failed_chunks`.
+
+        Returns:
+            list[Index]: The entries of the chunk.
+        """
+        index = None
+        truncated = False
+        if packer is not None and packer.is_small(text):
+            index = await packer.parse(text, self.llm_cache)
+        if index is None:
+            try:
+                index = await llm_parse_index(text, self.llm_cache, client or self.llm_client, self.prompt_stats)
+            except TruncatedResponse as e:
+                index = e.text
+                truncated = True
+        results = []
+        if index is None:
+            print("No LLM response for a chunk, skipping it.")
+            self.failed_chunks += 1
+            metrics.count("failed_chunks_total", reason="no_response")
+            return results
+        # Decode the first JSON list of the response, like stream_chunk: a
+        # ```json fence or a note around it is skipped
+        decoder = JSONArrayStream()
+        parsed_index = decoder.feed(index)
+        if decoder.invalid:
+            # A missing comma or quote in an entry
+            metrics.count("json_repairs_total", len(decoder.invalid))
+            parsed_index.extend(json_repair.loads(item) for item in decoder.invalid)
+        if not decoder.started:
+            print(index)
+            print("The LLM response of a chunk is not a JSON list, skipping it.")
+            self.failed_chunks += 1
+            metrics.count("failed_chunks_total", reason="invalid_json")
+            return results
+        # Only the finish reason of the response tells that it was cut short
+        if not truncated and not decoder.closed:
+            self.incomplete_response()
+        if truncated:
+            parts = split_chunk(text.splitlines()) if depth < MAX_SPLIT_DEPTH else [text]
+            if len(parts) > 1:
+                print(f"Truncated LLM response, parsing the chunk in {len(parts)} parts.")
+                metrics.count("chunk_splits_total")
+                for part in parts:
+                    results.extend(await self.process_chunk("\n".join(part), client, depth + 1))
+                return results
+            print("Truncated LLM response for a chunk that can not be split, keeping the partial entries.")
+            self.failed_chunks += 1
+            metrics.count("failed_chunks_total", reason="truncated")
+        for entry in parsed_index:
+            index_entry = self.index_entry(entry)
+            if index_entry is not None:
+                results.append(index_entry)
         return results
 
+    def incomplete_response(self):
+        """Counts a response whose JSON list is not closed, though the LLM did not stop at the token limit."""
+        print("The JSON list of an LLM response is not closed, keeping its complete entries.")
+        self.failed_chunks += 1
+        metrics.count("failed_chunks_total", reason="incomplete")
+
+    def index_entry(self, entry):
+        """Converts an entry of the LLM response, {"t": term, "o": occurrences}, to an Index, or None if incomplete."""
+        if not isinstance(entry, dict) or "t" not in entry or not isinstance(entry.get("o"), list):
+            # The last entry of a truncated response
+            print(f"Skipping incomplete entry: {entry}")
+            return None
+        term = entry["t"]
+        occurrences = entry["o"]
+        occurrences_list = []
+        for occurrence in occurrences:
+            try:
+                if (len(occurrence) == 1):
+                    start = occurrence[0]
+                    end = occurrence[0]
+                else:
+                    start = occurrence[0]
+                    end = occurrence[1]
+                occurrences_list.append((start, end))
+            except Exception as e:
+                print(f"Error parsing occurrence: {e}, occurrence: {occurrence}")
+        return Index(term, occurrences_list)
+
+    async def stream_chunk(self, text, emit, client=None, depth=0, emitted=None, packer=None):
+        """
+        Parses a chunk of index text with the streaming API of the LLM, and
+        passes its entries to `emit` as soon as each one is generated.
+
+        A truncated response is handled like in `process_chunk`: the entries
+        already generated are kept, and the parts of the split chunk are
+        parsed again without emitting those entries twice. When the stream
+        is interrupted, the chunk is parsed again by `process_chunk`, whose
+        request is retried, and only the entries not emitted yet are passed.
+
+        Args:
+            text (str): The chunk.
+            emit (callable): Called with each list of new Index entries.
+            client (LLMClient): The client, `llm_client` by default.
+            depth (int): The times the chunk was split.
+            emitted (set): The (term, occurrences) of the entries already
+                emitted for the chunk this one was split from.
+            packer (RequestPacker): Packs a small chunk with others, its
+                response then arrives whole.
+        """
+        if emitted is None:
+            emitted = set()
+        decoder = JSONArrayStream()
+        truncated = False
+        received = False
+
+        def emit_entries(entries):
+            new_entries = []
+            for entry in entries:
+                key = (entry.term, tuple(entry.occurrences))
+                if key not in emitted:
+                    emitted.add(key)
+                    new_entries.append(entry)
+            if new_entries:
+                emit(new_entries)
+
+        def emit_new(items):
+            emit_entries(entry for entry in map(self.index_entry, items) if entry is not None)
+
+        packed = await packer.parse(text, self.llm_cache) if packer is not None and packer.is_small(text) else None
+        try:
+            if packed is not None:
+                received = True
+                emit_new(decoder.feed(packed))
+            else:
+                async for fragment in llm_stream_parse_index(
+                    text, self.llm_cache, client or self.llm_client, self.prompt_stats
+                ):
+                    received = True
+                    emit_new(decoder.feed(fragment))
+        except TruncatedResponse:
+            truncated = True
+        except StreamInterrupted as e:
+            print(f"{e}, parsing the chunk again without streaming.")
+            metrics.count("stream_retries_total")
+            emit_entries(await self.process_chunk(text, client, depth))
+            return
+        if decoder.invalid:
+            # A missing comma or quote in an entry
+            metrics.count("json_repairs_total", len(decoder.invalid))
+            emit_new(json_repair.loads(item) for item in decoder.invalid)
+        if not received:
+            print("No LLM response for a chunk, skipping it.")
+            self.failed_chunks += 1
+            metrics.count("failed_chunks_total", reason="no_response")
+            return
+        if not decoder.started:
+            print("The LLM response of a chunk is not a JSON list, skipping it.")
+            self.failed_chunks += 1
+            metrics.count("failed_chunks_total", reason="invalid_json")
+            return
+        if not truncated:
+            if not decoder.closed:
+                self.incomplete_response()
+            return
+        parts = split_chunk(text.splitlines()) if depth < MAX_SPLIT_DEPTH else [text]
+        if len(parts) > 1:
+            print(f"Truncated LLM response, parsing the chunk in {len(parts)} parts.")
+            metrics.count("chunk_splits_total")
+            for part in parts:
+                await self.stream_chunk("\n".join(part), emit, client, depth + 1, emitted)
+            return
+        print("Truncated LLM response for a chunk that can not be split, keeping the partial entries.")
+        self.failed_chunks += 1
+        metrics.count("failed_chunks_total", reason="truncated")
+
 if __name__ == "__main__":
     doc = Document("pdf", "./resource/pdf/irrational.pdf")
     doc.filter_index_pages()
@@ -1,4 +1,134 @@
+import sys
+from array import array
+
+# Largest page number of the unsigned int arrays
+MAX_PAGE = 2 ** (8 * array("I").itemsize) - 1
+
+
 class Index:
-    def __init__(self, term, occurrence):
+    """A parsed index term and its list of (start, end) occurrences."""
+
+    __slots__ = ("term", "occurrences")
+
+    def __init__(self, term, occurrences):
         self.term = term
-        self.occurrence = occurrence  # List of tuples (start, end)
\ No newline at end of file
+        self.occurrences = occurrences  # List of tuples (start, end)
+
+    def __repr__(self):
+        return f"Index({self.term!r}, {self.occurrences!r})"
+
+
+class IndexEntry:
+    """
+    Read-only view of an entry of an IndexStore, with the `term` and
+    `occurrences` attributes of `Index`.
+    """
+
+    __slots__ = ("store", "position")
+
+    def __init__(self, store, position):
+        self.store = store
+        self.position = position
+
+    @property
+    def term(self):
+        return self.store.term(self.position)
+
+    @property
+    def occurrences(self):
+        return self.store.occurrences(self.position)
+
+    def __repr__(self):
+        return f"IndexEntry({self.term!r}, {self.occurrences!r})"
+
+
+class IndexStore:
+    """
+    Columnar store of index entries.
+
+    Term strings are interned in a table: each distinct term is stored once
+    and each entry only keeps the id of its term. The occurrences of all the entries are held in two shared
+    unsigned int arrays, `starts` and `ends`: the occurrences of entry `i` are
+    the items `offsets[i]` to `offsets[i + 1]`. Entries are read through
+    IndexEntry views, created on access.
+    """
+
+    def __init__(self):
+        self.term_table = []  # Unique term strings
+        self.term_ids = {}  # Position of each term string in term_table
+        self.entry_terms = array("I")  # Term id of each entry
+        self.offsets = array("I", [0])  # Start of the occurrences of each entry, plus the end
+        self.starts = array("I")
+        self.ends = array("I")
+
+    def __len__(self):
+        return len(self.entry_terms)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [IndexEntry(self, i) for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("IndexStore index out of range")
+        return IndexEntry(self, position)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield IndexEntry(self, position)
+
+    def intern(self, term):
+        """Returns the id of a term string, adding it to the table if needed."""
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.term_table)
+            self.term_table.append(term)
+        return term_id
+
+    def append(self, term, occurrences):
+        """
+        Adds an entry. Occurrences that are not pairs of non-negative integers
+        are skipped.
+
+        Returns:
+            int: The position of the entry.
+        """
+        for occurrence in occurrences:
+            try:
+                start, end = int(occurrence[0]), int(occurrence[1])
+                if not (0 <= start <= MAX_PAGE and 0 <= end <= MAX_PAGE):
+                    raise ValueError("page number out of range")
+            except (IndexError, TypeError, ValueError) as e:
+                print(f"Error storing occurrence: {e}, occurrence: {occurrence}")
+                continue
+            self.starts.append(start)
+            self.ends.append(end)
+        self.offsets.append(len(self.starts))
+        self.entry_terms.append(self.intern(term))
+        return len(self.entry_terms) - 1
+
+    def extend(self, entries):
+        """Adds entries that have `term` and `occurrences` attributes."""
+        for entry in entries:
+            self.append(entry.term, entry.occurrences)
+
+    def term(self, position):
+        return self.term_table[self.entry_terms[position]]
+
+    def occurrences(self, position):
+        """Returns the list of (start, end) occurrences of an entry."""
+        first, last = self.offsets[position], self.offsets[position + 1]
+        return list(zip(self.starts[first:last], self.ends[first:last]))
+
+    def clear(self):
+        self.__init__()
+
+    def nbytes(self):
+        """Returns the approximate memory used by the store, in bytes."""
+        arrays = (self.entry_terms, self.offsets, self.starts, self.ends)
+        return (
+            sum(array_.itemsize * len(array_) for array_ in arrays)
+            + sum(sys.getsizeof(term) for term in self.term_table)
+            + sys.getsizeof(self.term_table)
+            + sys.getsizeof(self.term_ids)
+        )
@@ -0,0 +1,228 @@
+import os
+import sys
+import mmap
+import struct
+import hashlib
+from array import array
+from src.index import IndexStore
+
+MAGIC = b"PDFINDEX"
+VERSION = 1
+# Magic, version, PDF digest, page difference, then the counts of index pages,
+# terms, entries and occurrences and the size of the string data
+HEADER = struct.Struct("<8sI32siIIIII4x")
+ALIGNMENT = 8
+# Files smaller than this are digested whole
+SAMPLED_DIGEST_MIN_SIZE = 4 * 1024 * 1024
+
+
+def pdf_digest(path, samples=16, sample_size=64 * 1024):
+    """
+    Computes a digest of a PDF file from its size and `samples` blocks spread
+    over the file, including the first and the last one, so that checking a
+    large book does not read all of it. Small files are digested whole.
+
+    Incremental updates of a PDF are appended at the end of the file, which
+    is always sampled.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(size.to_bytes(8, "little"))
+    with open(path, "rb") as f:
+        if size < SAMPLED_DIGEST_MIN_SIZE:
+            digest.update(f.read())
+            return digest.hexdigest()
+        last = size - sample_size
+        for i in range(samples):
+            f.seek(last * i // (samples - 1))
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def padding(size):
+    return -size % ALIGNMENT
+
+
+def little_endian(values):
+    """Returns the bytes of an unsigned int array in little-endian order."""
+    values = array("I", values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_index_file(path, digest, store, index_pages, page_difference):
+    """
+    Writes the parsed index of a document to a binary file.
+
+    After the header, the file holds the sections below, each padded to 8
+    bytes. Every number is a little-endian unsigned 32-bit int.
+
+    - The index pages.
+    - The string table: the offsets of the terms in the string data (one
+      more than the terms), then their UTF-8 data.
+    - The term id of each entry.
+    - The offsets of the occurrences of each entry (one more than the entries).
+    - The start pages, then the end pages of the occurrences.
+
+    The file is written next to `path` and then moved over it, so a reader
+    never sees a partial file.
+
+    Args:
+        path (str): The file to write.
+        digest (str): The hexadecimal digest of the PDF, see `pdf_digest`.
+        store (IndexStore): The parsed entries.
+        index_pages (list[int]): The index pages of the document.
+        page_difference (int): The page number difference of the document.
+    """
+    encoded = [term.encode("utf-8") for term in store.term_table]
+    string_offsets = array("I", [0])
+    for term in encoded:
+        string_offsets.append(string_offsets[-1] + len(term))
+    header = HEADER.pack(
+        MAGIC, VERSION, bytes.fromhex(digest), page_difference, len(index_pages), len(encoded), len(store),
+        len(store.starts), string_offsets[-1],
+    )
+    sections = [
+        little_endian(index_pages),
+        little_endian(string_offsets),
+        b"".join(encoded),
+        little_endian(store.entry_terms),
+        little_endian(store.offsets),
+        little_endian(store.starts),
+        little_endian(store.ends),
+    ]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(header)
+        for section in sections:
+            f.write(section)
+            f.write(b"\0" * padding(len(section)))
+    os.replace(temporary_path, path)
+
+
+class TermTable:
+    """The term strings of a mapped index file, decoded on access."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id):
+        if not 0 <= term_id < len(self):
+            raise IndexError("term id out of range")
+        return str(self.data[self.offsets[term_id]:self.offsets[term_id + 1]], "utf-8")
+
+    def __iter__(self):
+        for term_id in range(len(self)):
+            yield self[term_id]
+
+
+class MappedIndexStore(IndexStore):
+    """
+    Read-only IndexStore over an index file written by `write_index_file`.
+
+    The file is memory-mapped and its arrays are read in place, so opening it
+    only costs the header checks; the pages of the file are read as the
+    entries are accessed. The terms are decoded on access.
+
+    Use `open`, which checks the file against the digest of the PDF.
+    """
+
+    def __init__(self, path, mapped, header):
+        _, _, _, self.page_difference, page_count, term_count, entry_count, occurrence_count, string_size = header
+        self.path = path
+        self.mapped = mapped
+        self.views = []
+        position = HEADER.size
+
+        def take(size, item_format=None):
+            nonlocal position
+            view = memoryview(mapped)[position:position + size]
+            position += size + padding(size)
+            if item_format is not None:
+                view = view.cast(item_format)
+                if sys.byteorder != "little":
+                    # Not in place on big-endian machines
+                    view = array(item_format, view)
+                    view.byteswap()
+            self.views.append(view)
+            return view
+
+        self.index_pages = list(take(4 * page_count, "I"))
+        string_offsets = take(4 * (term_count + 1), "I")
+        self.term_table = TermTable(string_offsets, take(string_size))
+        self.entry_terms = take(4 * entry_count, "I")
+        self.offsets = take(4 * (entry_count + 1), "I")
+        self.starts = take(4 * occurrence_count, "I")
+        self.ends = take(4 * occurrence_count, "I")
+
+    @staticmethod
+    def expected_size(header):
+        _, _, _, _, page_count, term_count, entry_count, occurrence_count, string_size = header
+        sizes = (
+            4 * page_count, 4 * (term_count + 1), string_size, 4 * entry_count, 4 * (entry_count + 1),
+            4 * occurrence_count, 4 * occurrence_count,
+        )
+        return HEADER.size + sum(size + padding(size) for size in sizes)
+
+    @classmethod
+    def open(cls, path, digest):
+        """
+        Opens an index file if it is valid and belongs to the PDF with this
+        digest.
+
+        Returns:
+            MappedIndexStore: The store, or None if the file is missing, of
+            another version, of another PDF or truncated.
+        """
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Missing, or empty which cannot be mapped
+            return None
+        reason = None
+        header = None
+        if len(mapped) < HEADER.size:
+            reason = "truncated header"
+        else:
+            header = HEADER.unpack_from(mapped)
+            if header[0] != MAGIC:
+                reason = "not an index file"
+            elif header[1] != VERSION:
+                reason = f"version {header[1]}"
+            elif header[2] != bytes.fromhex(digest):
+                reason = "the PDF changed"
+            elif len(mapped) != cls.expected_size(header):
+                reason = "truncated data"
+        if reason is not None:
+            print(f"Ignoring saved index {path}: {reason}")
+            mapped.close()
+            return None
+        return cls(path, mapped, header)
+
+    def append(self, term, occurrences):
+        raise TypeError("MappedIndexStore is read-only, copy it to an IndexStore to add entries")
+
+    def clear(self):
+        raise TypeError("MappedIndexStore is read-only")
+
+    def nbytes(self):
+        """Returns the size of the mapped file, in bytes."""
+        return len(self.mapped)
+
+    def close(self):
+        """Unmaps the file. The store and its entries can no longer be read."""
+        for view in self.views:
+            if isinstance(view, memoryview):
+                view.release()
+        self.views = []
+        self.mapped.close()
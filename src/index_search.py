@@ -0,0 +1,185 @@
+import re
+from bisect import bisect_left
+import numpy as np
+
+# Page ranges longer than this are searched linearly by the reverse index
+MAX_SHORT_RANGE = 32
+# Positions where a word starts in a term, after the first one
+WORD_START_PATTERN = re.compile(r"(?<=[\s:,(\-])(?=\w)")
+
+
+def normalize(text):
+    """Returns the search key of a term: case folded, with single spaces."""
+    return " ".join(text.casefold().split())
+
+
+def common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+def next_prefix(prefix):
+    """Returns the smallest string greater than every string starting with `prefix`."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class IndexSearch:
+    """
+    Query layer over the entries of an IndexStore.
+
+    - `prefix`: terms that start with a query, or that have a word starting
+      with it, by binary search over the sorted word suffixes of the terms.
+    - `fuzzy`: terms within a bounded edit distance of a query, for OCR
+      errors. The sorted terms are walked as an implicit trie: the rows of the
+      edit distance table are shared between terms with a common prefix, and
+      the terms under a prefix that is already too far are skipped.
+    - `entries_for_page`: the entries with an occurrence on a page. Ranges are
+      sorted by start, so only the ranges that start at most MAX_SHORT_RANGE
+      pages before the page are checked, plus the few longer ranges.
+
+    The search is built once from the store; build a new one when entries are
+    added.
+
+    Args:
+        store (IndexStore): The parsed entries.
+    """
+
+    def __init__(self, store):
+        self.size = len(store)
+        self.keys = [normalize(term) for term in store.term_table]
+
+        # Entries of each term id, grouped by term
+        entry_terms = np.array(store.entry_terms, dtype=np.uint32)
+        self.term_entries = np.argsort(entry_terms, kind="stable").astype(np.uint32)
+        self.term_offsets = np.searchsorted(entry_terms[self.term_entries], np.arange(len(self.keys) + 1))
+
+        # Distinct keys in order
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.sorted_keys = [self.keys[term_id] for term_id in order]
+        self.sorted_terms = order
+
+        # Sorted suffixes of the keys from their second word on, and their term id
+        suffixes = sorted(
+            (key[match.start():], term_id)
+            for term_id, key in enumerate(self.keys)
+            for match in WORD_START_PATTERN.finditer(key)
+        )
+        self.suffix_keys = [suffix for suffix, _ in suffixes]
+        self.suffix_terms = [term_id for _, term_id in suffixes]
+
+        # Occurrence ranges by start, for the reverse index
+        # Copies, a view would keep the arrays of the store from growing
+        offsets = np.array(store.offsets, dtype=np.int64)
+        starts = np.array(store.starts, dtype=np.int64)
+        ends = np.array(store.ends, dtype=np.int64)
+        entries = np.repeat(np.arange(self.size, dtype=np.uint32), np.diff(offsets))
+        ends = np.maximum(starts, ends)
+        short = ends - starts <= MAX_SHORT_RANGE
+        order = np.argsort(starts[short], kind="stable")
+        self.short_starts = starts[short][order]
+        self.short_ends = ends[short][order]
+        self.short_entries = entries[short][order]
+        self.long_starts = starts[~short]
+        self.long_ends = ends[~short]
+        self.long_entries = entries[~short]
+
+    def entries_of_terms(self, term_ids):
+        """Returns the entry positions of term ids, in the order of the terms."""
+        positions = []
+        for term_id in term_ids:
+            positions.extend(self.term_entries[self.term_offsets[term_id]:self.term_offsets[term_id + 1]].tolist())
+        return positions
+
+    def prefix(self, query, limit=100):
+        """
+        Returns the positions of the entries whose term, or one of its words,
+        starts with the query. Terms that start with the query come first, in
+        alphabetical order. Only the first `limit` entries are looked up.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        end = next_prefix(query)
+        first = bisect_left(self.sorted_keys, query)
+        last = bisect_left(self.sorted_keys, end, first)
+        positions = self.entries_of_terms(self.sorted_terms[first:min(last, first + limit)])
+        if len(positions) >= limit:
+            return positions[:limit]
+        # Then the terms with a later word that starts with the query, in the order of that word
+        first = bisect_left(self.suffix_keys, query)
+        last = bisect_left(self.suffix_keys, end, first)
+        seen = set()
+        for term_id in self.suffix_terms[first:last]:
+            if term_id in seen or self.keys[term_id].startswith(query):
+                continue
+            seen.add(term_id)
+            positions.extend(self.entries_of_terms([term_id]))
+            if len(positions) >= limit:
+                break
+        return positions[:limit]
+
+    def fuzzy(self, query, max_distance=2, limit=50, prefix=False):
+        """
+        Returns the positions of the entries whose term is within
+        `max_distance` edits (insertions, deletions, substitutions) of the
+        query, closest first.
+
+        With `prefix`, the query only has to be close to the start of the
+        term, to search while typing.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        keys = self.sorted_keys
+        rows = [list(range(len(query) + 1))]  # rows[j]: distances after the first j characters of the key
+        previous = ""
+        matches = []
+        i = 0
+        while i < len(keys):
+            key = keys[i]
+            shared = min(common_prefix_length(previous, key), len(rows) - 1)
+            del rows[shared + 1:]
+            best = min(row[-1] for row in rows) if prefix else None
+            pruned = False
+            for j in range(shared, len(key)):
+                above = rows[-1]
+                row = [above[0] + 1]
+                for k, char in enumerate(query):
+                    row.append(min(row[k] + 1, above[k + 1] + 1, above[k] + (char != key[j])))
+                rows.append(row)
+                if prefix:
+                    best = min(best, row[-1])
+                if min(row) > max_distance:
+                    pruned = True
+                    break
+            distance = best if prefix else rows[-1][-1]
+            if distance is not None and distance <= max_distance:
+                matches.append((distance, key, self.sorted_terms[i]))
+            if pruned:
+                # No key that starts with this prefix can get closer
+                previous = key[:len(rows) - 1]
+                skip_to = bisect_left(keys, next_prefix(previous), i + 1)
+                if distance is not None and distance <= max_distance:
+                    # In prefix mode, they all match at the same distance
+                    matches.extend((distance, keys[k], self.sorted_terms[k]) for k in range(i + 1, skip_to))
+                i = skip_to
+                continue
+            previous = key
+            i += 1
+        matches.sort()
+        return self.entries_of_terms(term_id for _, _, term_id in matches)[:limit]
+
+    def entries_for_page(self, page):
+        """Returns the sorted positions of the entries with an occurrence on `page`."""
+        return self.entries_for_pages(page, page)
+
+    def entries_for_pages(self, first, last):
+        """Returns the sorted positions of the entries with an occurrence between pages `first` and `last`."""
+        low = np.searchsorted(self.short_starts, first - MAX_SHORT_RANGE, side="left")
+        high = np.searchsorted(self.short_starts, last, side="right")
+        short = self.short_entries[low:high][self.short_ends[low:high] >= first]
+        wide = self.long_entries[(self.long_starts <= last) & (self.long_ends >= first)]
+        return np.unique(np.concatenate((short, wide))).tolist()
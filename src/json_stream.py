@@ -0,0 +1,105 @@
+import re
+import json
+
+# Characters that change the nesting or the string state
+STRUCTURE_PATTERN = re.compile(r'[\[\]{}"]')
+# Ends of a string: a quote or an escape
+STRING_PATTERN = re.compile(r'["\\]')
+
+
+class JSONArrayStream:
+    """
+    Incremental decoder of a JSON array of objects, for LLM output that is
+    still being generated.
+
+    Each object of the top-level array is decoded as soon as its closing
+    brace arrives, so the first entries of a response are usable long before
+    the response ends. Text before the array, like a ```json fence, is
+    skipped. Only the characters that change the nesting or start and end a
+    string are visited, by regex, and the decoded text is dropped from the
+    buffer.
+
+    Usage:
+        decoder = JSONArrayStream()
+        for fragment in fragments:
+            for item in decoder.feed(fragment):
+                ...
+        decoder.closed  # Whether the array was complete
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0  # Next character of the buffer to scan
+        self.depth = 0  # 1 inside the array, 2 inside one of its items
+        self.in_string = False
+        self.item_start = None  # Position of the item being read in the buffer
+        self.started = False  # Whether the array was opened
+        self.closed = False  # Whether the array was closed
+        self.invalid = []  # Text of the items that were not valid JSON
+
+    def feed(self, text):
+        """
+        Adds the next fragment of the text.
+
+        Returns:
+            list: The items of the array completed by this fragment.
+        """
+        if self.closed:
+            return []
+        self.buffer += text
+        items = []
+        buffer = self.buffer
+        position = self.position
+        while True:
+            if self.in_string:
+                match = STRING_PATTERN.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                if match.group() == "\\":
+                    if match.end() >= len(buffer):
+                        # The escaped character has not arrived yet
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                    continue
+                self.in_string = False
+                position = match.end()
+                continue
+            match = STRUCTURE_PATTERN.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            char = match.group()
+            position = match.end()
+            if not self.started:
+                # Skip the text before the array
+                if char == "[":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                if self.depth == 1:
+                    self.item_start = match.start()
+                self.depth += 1
+            elif self.depth == 1:
+                # The end of the array
+                self.closed = True
+                break
+            else:
+                self.depth -= 1
+                if self.depth == 1:
+                    try:
+                        items.append(json.loads(buffer[self.item_start:position]))
+                    except json.JSONDecodeError:
+                        self.invalid.append(buffer[self.item_start:position])
+                    self.item_start = None
+        # Keep only the item being read
+        keep = self.item_start if self.item_start is not None else position
+        self.buffer = buffer[keep:]
+        self.position = position - keep
+        if self.item_start is not None:
+            self.item_start = 0
+        return items
@@ -1,57 +1,412 @@
 import os
-import requests
 import json
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import aiohttp
+from utils.rate_limiter import KeyPool
+from utils.metrics import metrics
 
 load_dotenv()
 
-async def llm_call(text):
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent"
+# Statuses of transient errors, the request is retried
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class TruncatedResponse(Exception):
+    """The response was cut at the output token limit. `text` is the partial output."""
+
+    def __init__(self, text):
+        super().__init__("The LLM response was truncated")
+        self.text = text
+
+
+class StreamInterrupted(Exception):
+    """The connection failed while the streamed response was read. `text` is the output received."""
+
+    def __init__(self, text, reason):
+        super().__init__(f"The LLM stream was interrupted ({reason})")
+        self.text = text
+
+
+def parse_retry_after(value):
+    """Returns the seconds of a Retry-After header, in seconds or as an HTTP date, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def keys_from_env(keys_variable="GEMINI_API_KEYS", key_variable="GEMINI_API_KEY"):
+    """
+    Returns the API keys of the `keys_variable` variable (comma separated),
+    or the single key of `key_variable`.
+    """
+    keys = os.getenv(keys_variable)
+    if keys:
+        return [key.strip() for key in keys.split(",") if key.strip()]
+    key = os.getenv(key_variable)
+    return [key] if key else []
+
+
+async def sse_events(response):
+    """Yields the data of the server-sent events of a response."""
+    data = []
+    async for line in response.content:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data:
+                yield "\n".join(data)
+                data = []
+        elif line.startswith("data:"):
+            value = line[len("data:"):]
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield "\n".join(data)
+
+
+class LLMClient:
+    """
+    Client for the Gemini API that owns one long-lived HTTP session.
+
+    The session and its connection pool are created on first use and reused by
+    every call, so concurrent chunks share keep-alive connections instead of
+    paying a TCP and TLS handshake each. The session is bound to the running
+    event loop: close the client (or use it as an async context manager)
+    before that loop ends. A closed client can be used again in another loop.
+
+    Requests are spread over a pool of API keys, each limited to
+    `calls_per_key` calls per `period` seconds.
+
+    Transient errors (429, 5xx, timeouts and connection errors) are retried
+    up to `max_retries` times, after a random delay of up to `backoff`
+    seconds, doubled at each attempt and at most `max_backoff`. A 429 or 503
+    response with a Retry-After header is retried after that delay instead,
+    plus a jitter so that the waiting requests do not come back at once.
+
+    Other backends (see src/llm_backends.py) override `build_request` and
+    `parse_response` for their API, and `key_variables` for their keys.
+
+    Args:
+        api_key (str): The API key. Defaults to the keys of the environment,
+            see `keys_from_env`.
+        url (str): The generateContent URL of the model.
+        key_pool (KeyPool): A key pool to share with other clients. Overrides
+            `api_key`, `calls_per_key` and `period`.
+        calls_per_key (int): Calls allowed per key and period.
+        period (float): The rate limit period, in seconds.
+        connection_limit (int): Maximum number of simultaneous connections.
+        keepalive_timeout (float): Seconds an idle connection is kept open.
+        dns_cache_ttl (int): Seconds a DNS resolution is cached.
+        timeout (float): Total timeout of one request, in seconds.
+        connect_timeout (float): Timeout to establish a connection, in seconds.
+        max_retries (int): Retries of a request after a transient error.
+        backoff (float): The maximum delay of the first retry, in seconds.
+        max_backoff (float): The maximum delay of a retry without
+            Retry-After, in seconds.
+    """
+
+    key_variables = ("GEMINI_API_KEYS", "GEMINI_API_KEY")
+
+    def __init__(self, api_key=None, url=GEMINI_URL, key_pool=None, calls_per_key=15, period=60,
+                 connection_limit=20, keepalive_timeout=60, dns_cache_ttl=300, timeout=180, connect_timeout=15,
+                 max_retries=4, backoff=1.0, max_backoff=60.0):
+        self.api_key = api_key
+        self.key_pool = key_pool
+        self.calls_per_key = calls_per_key
+        self.period = period
+        self.url = url
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.random = random.Random()
+        self.session = None
+        self.loop = None
+
+    @property
+    def cache_id(self):
+        """Identifies the model in the LLM cache keys, see `llm_cache.response_key`."""
+        return self.url
+
+    def get_session(self):
+        loop = asyncio.get_running_loop()
+        if self.session is not None and (self.session.closed or self.loop is not loop):
+            # The previous loop is gone, its connections can not be reused
+            self.session = None
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.loop = loop
+        return self.session
+
+    def get_key_pool(self):
+        if self.key_pool is None:
+            keys = [self.api_key] if self.api_key else keys_from_env(*self.key_variables)
+            if not keys:
+                raise ValueError(f"No API key found, set {' or '.join(reversed(self.key_variables))}")
+            self.key_pool = KeyPool(keys, self.calls_per_key, self.period)
+        return self.key_pool
+
+    def build_request(self, text, api_key):
+        """Returns the URL, headers and JSON body of a generateContent request."""
+        url = f"{self.url}?key={api_key}"
+        headers = {
+            "Content-Type": "application/json"
+        }
+        data = {
+            "contents": [
+                {
+                    "parts": [
+                        {
+                            "text": text
+                        }
+                    ]
+                }
+            ]
+        }
+        return url, headers, data
+
+    def parse_response(self, response_data):
+        """Returns the generated text of a generateContent response."""
+        return response_data['candidates'][0]['content']['parts'][0]['text']
+
+    def build_stream_request(self, text, api_key):
+        """Returns the URL, headers and JSON body of a streamGenerateContent request, with server-sent events."""
+        url, headers, data = self.build_request(text, api_key)
+        return f"{self.stream_url}?alt=sse&key={api_key}", headers, data
+
+    @property
+    def stream_url(self):
+        return self.url.replace(":generateContent", ":streamGenerateContent")
+
+    def parse_stream_event(self, event_data):
+        """Returns the text of a streamGenerateContent event and whether the generation stopped at the token limit."""
+        candidate = event_data['candidates'][0]
+        parts = candidate.get('content', {}).get('parts', [])
+        return "".join(part.get('text', "") for part in parts), candidate.get('finishReason') == "MAX_TOKENS"
+
+    def is_truncated(self, response_data):
+        """Whether the generation stopped at the output token limit."""
+        return response_data['candidates'][0].get('finishReason') == "MAX_TOKENS"
+
+    def retry_delay(self, attempt, retry_after=None):
+        """Returns the seconds to wait before retry number `attempt` (from 0)."""
+        if retry_after is not None:
+            return retry_after + self.random.uniform(0, self.backoff)
+        return self.random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def post(self, text, build_request, read=None):
+        """
+        Sends a request built by `build_request(text, api_key)`, retrying
+        transient errors.
+
+        Args:
+            text (str): The input text.
+            build_request (callable): Returns the URL, headers and JSON body.
+            read (callable): Optional, async, reads the body of the response
+                with status 200. An error reading it, like a timeout or a body
+                that is not JSON, is retried like a connection error.
+
+        Returns:
+            The result of `read`, or without it the aiohttp.ClientResponse
+            with status 200, to read and release. None if the request failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            api_key = await self.get_key_pool().acquire()
+            print("Calling LLM...")
+            url, headers, data = build_request(text, api_key)
+            retry_after = None
+            try:
+                response = await self.get_session().post(url, headers=headers, json=data)
+                metrics.count("llm_responses_total", status=response.status)
+                if response.status == 200 and read is not None:
+                    async with response:
+                        return await read(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                # ValueError: a body that is not valid JSON
+                reason = type(e).__name__
+            else:
+                if response.status == 200:
+                    return response
+                response.release()
+                if response.status not in RETRY_STATUSES:
+                    print(f"LLM request failed with status {response.status}")
+                    return None
+                reason = str(response.status)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if attempt == self.max_retries:
+                print(f"LLM request failed ({reason}) after {attempt + 1} attempts")
+                return None
+            delay = self.retry_delay(attempt, retry_after)
+            print(f"LLM request failed ({reason}), retrying in {delay:.1f}s")
+            metrics.count("llm_retries_total", reason=reason)
+            await asyncio.sleep(delay)
+
+    async def call(self, text):
+        """
+        Calls the Gemini API to generate content based on the provided text.
+
+        Args:
+            text (str): The input text to be processed by the Gemini API.
+
+        Returns:
+            str: The generated content, or None if the request failed, after
+            the retries of transient errors, or the response has no content.
+
+        Raises:
+            TruncatedResponse: If the output was cut at the token limit.
+        """
+        # An HTML page from a proxy, or a body cut by a timeout, is retried
+        response_data = await self.post(text, self.build_request, read=lambda response: response.json())
+        if response_data is None:
+            return None
+        try:
+            return_data = self.parse_response(response_data)
+            truncated = self.is_truncated(response_data)
+        except Exception as e:
+            print(e)
+            return None
+        if truncated:
+            raise TruncatedResponse(return_data)
+        return return_data
+
+    async def stream(self, text):
+        """
+        Calls the streaming API and yields the generated text in fragments, as
+        they are generated. Transient errors are retried until the response
+        starts.
+
+        Yields:
+            str: The next fragment of the generated content. Nothing if the
+            request failed.
+
+        Raises:
+            TruncatedResponse: After the last fragment, if the output was cut
+            at the token limit.
+            StreamInterrupted: If reading the response failed, a payload
+            error or a timeout, after some fragments maybe.
+        """
+        response = await self.post(text, self.build_stream_request)
+        if response is None:
+            return
+        fragments = []
+        truncated = False
+        async with response:
+            try:
+                async for data in sse_events(response):
+                    if data == "[DONE]":
+                        break
+                    try:
+                        fragment, finished_at_limit = self.parse_stream_event(json.loads(data))
+                    except (ValueError, LookupError, TypeError) as e:
+                        print(f"Invalid LLM stream event: {e}")
+                        continue
+                    truncated = truncated or finished_at_limit
+                    if fragment:
+                        fragments.append(fragment)
+                        yield fragment
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # The fragments already yielded can not be taken back, the caller retries
+                raise StreamInterrupted("".join(fragments), type(e).__name__) from e
+        if truncated:
+            raise TruncatedResponse("".join(fragments))
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def llm_call(text, client=None):
     """
     Calls the Gemini API to generate content based on the provided text.
 
     Args:
         text (str): The input text to be processed by the Gemini API.
+        client (LLMClient): The client to send the request with. Without one,
+            a client is created and closed for this call only.
 
     Returns:
         str: The generated content from the Gemini API.
 
     Raises:
-        KeyError: If the response does not contain the expected keys.
-        requests.exceptions.RequestException: If there is an issue with the HTTP request.
+        TruncatedResponse: If the output was cut at the token limit.
 
     Environment Variables:
         GEMINI_API_KEY: The API key for authenticating with the Gemini API.
+        GEMINI_API_KEYS: Comma-separated API keys to spread the requests over.
     """
-    print("Calling LLM...")
-    api_key = os.getenv('GEMINI_API_KEY')
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={api_key}"
-    headers = {
-        "Content-Type": "application/json"
-    }
-    data = {
-        "contents": [
-            {
-                "parts": [
-                    {
-                        "text": text
-                    }
-                ]
-            }
-        ]
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            response_data = await response.json()
-            try:
-                return_data = response_data['candidates'][0]['content']['parts'][0]['text']
-            except Exception as e:
-                print(e)
-                return None
-            return return_data
+    if client is None:
+        async with LLMClient() as client:
+            return await llm_call(text, client)
+    backend = type(client).__name__
+    metrics.count("llm_calls_total", backend=backend)
+    metrics.count("llm_input_chars_total", len(text), backend=backend)
+    with metrics.timer("llm_call_seconds", backend=backend):
+        response = await client.call(text)
+    if response is not None:
+        metrics.count("llm_output_chars_total", len(response), backend=backend)
+    return response
+
+
+async def llm_stream(text, client=None):
+    """
+    Calls the streaming API of the LLM, see `LLMClient.stream`.
+
+    Args:
+        text (str): The input text.
+        client (LLMClient): The client to send the request with. Without one,
+            a client is created and closed for this call only.
+
+    Yields:
+        str: The fragments of the generated content, as they arrive.
+
+    Raises:
+        TruncatedResponse: If the output was cut at the token limit.
+        StreamInterrupted: If reading the response failed.
+    """
+    if client is None:
+        async with LLMClient() as client:
+            async for fragment in llm_stream(text, client):
+                yield fragment
+        return
+    backend = type(client).__name__
+    metrics.count("llm_calls_total", backend=backend)
+    metrics.count("llm_input_chars_total", len(text), backend=backend)
+    start = time.perf_counter()
+    first = True
+    with metrics.timer("llm_call_seconds", backend=backend):
+        async for fragment in client.stream(text):
+            if first:
+                metrics.observe("llm_first_fragment_seconds", time.perf_counter() - start, backend=backend)
+                first = False
+            metrics.count("llm_output_chars_total", len(fragment), backend=backend)
+            yield fragment
 
 # Example usage
 if __name__ == "__main__":
-    import asyncio
-
-    result = asyncio.run(llm_call("Explain how AI works"))
\ No newline at end of file
+    result = asyncio.run(llm_call("Explain how AI works"))
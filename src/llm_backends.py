@@ -0,0 +1,234 @@
+import asyncio
+import json
+import random
+import re
+from src.llm import LLMClient
+from src.chunker import CONTEXT_PREFIX, estimate_tokens
+from src.local_index_parse import parse_occurrences, SECTION_HEADER_PATTERN
+from src.llm_index_parse import SECTION_HEADER_PATTERN as PACKED_SECTION_PATTERN
+
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+# Default address of the mock server, see src/mock_llm_server.py
+LOCAL_URL = "http://127.0.0.1:8765/v1beta/models/mock:generateContent"
+
+# Characters of each fragment of the simulated streaming responses
+STREAM_FRAGMENT_SIZE = 32
+
+# A term followed by its page numbers, the term may be empty on wrapped lines
+LINE_PATTERN = re.compile(r"^(?P<term>.*?),?\s*(?P<pages>\d[\d\s,\-–]*)$")
+
+
+class GeminiBackend(LLMClient):
+    """The Gemini generateContent API, see `LLMClient`."""
+
+
+class OpenAIBackend(LLMClient):
+    """
+    An OpenAI-compatible chat completions API.
+
+    The keys are read from OPENAI_API_KEYS (comma separated) or
+    OPENAI_API_KEY, and sent as a bearer token.
+
+    Args:
+        model (str): The model name of the requests.
+        url (str): The chat completions URL, for other compatible servers.
+        **kwargs: The other arguments of `LLMClient`.
+    """
+
+    key_variables = ("OPENAI_API_KEYS", "OPENAI_API_KEY")
+
+    def __init__(self, api_key=None, model="gpt-4o-mini", url=OPENAI_URL, **kwargs):
+        super().__init__(api_key=api_key, url=url, **kwargs)
+        self.model = model
+
+    @property
+    def cache_id(self):
+        return f"{self.url}#{self.model}"
+
+    def build_request(self, text, api_key):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        }
+        data = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": text}],
+        }
+        return self.url, headers, data
+
+    def parse_response(self, response_data):
+        return response_data["choices"][0]["message"]["content"]
+
+    def is_truncated(self, response_data):
+        return response_data["choices"][0].get("finish_reason") == "length"
+
+    def build_stream_request(self, text, api_key):
+        url, headers, data = self.build_request(text, api_key)
+        return url, headers, dict(data, stream=True)
+
+    def parse_stream_event(self, event_data):
+        choice = event_data["choices"][0]
+        return choice.get("delta", {}).get("content") or "", choice.get("finish_reason") == "length"
+
+
+class LocalBackend(LLMClient):
+    """
+    A local stand-in server that speaks the Gemini API, like the mock server
+    of src/mock_llm_server.py. No API key is needed and the rate limit is
+    high enough to measure the pipeline rather than the limiter.
+    """
+
+    def __init__(self, url=LOCAL_URL, api_key="local", calls_per_key=1000, period=1, **kwargs):
+        super().__init__(api_key=api_key, url=url, calls_per_key=calls_per_key, period=period, **kwargs)
+
+
+def parse_index_lines(text):
+    """
+    Parses index lines the way the prompt asks the LLM to, for well-formed
+    indexes like the synthetic books of bench/synthetic_book.py.
+
+    Parent terms end with a colon, their subtopics start with a lowercase
+    letter and are named "under parent: term". A line that ends with a comma
+    continues on the next line. The entries of the sections of a packed
+    prompt are tagged with their section, as "s".
+
+    Returns:
+        list[dict]: The {"t": term, "o": [[start, end]]} entries.
+    """
+    entries = []
+    parent = None
+    pending = ""
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        match = PACKED_SECTION_PATTERN.match(line)
+        if match:
+            section = int(match.group(1))
+            parent = None
+            pending = ""
+            continue
+        if line.startswith(CONTEXT_PREFIX):
+            parent = line[len(CONTEXT_PREFIX):].strip().rstrip(":")
+            continue
+        if not line or SECTION_HEADER_PATTERN.match(line):
+            continue
+        if pending:
+            line = f"{pending} {line}"
+            pending = ""
+        if line.endswith(","):
+            pending = line
+            continue
+        if line.endswith(":"):
+            parent = line[:-1]
+            continue
+        match = LINE_PATTERN.match(line)
+        occurrences = parse_occurrences(match.group("pages").rstrip(", ")) if match else None
+        if not occurrences:
+            continue
+        term = match.group("term").strip()
+        if not term:
+            # A lone number, like a page number in the footer
+            continue
+        if term[0].isupper():
+            parent = None
+        elif parent:
+            term = f"under {parent}: {term}"
+        entry = {"t": term, "o": [list(occurrence) for occurrence in occurrences]}
+        entries.append(entry if section is None else dict(s=section, **entry))
+    return entries
+
+
+def fake_index_response(prompt):
+    """Returns the response of a fake LLM to an index prompt, a ```json fenced list of entries."""
+    index_text = prompt.split("The input text is:")[-1]
+    return "```json\n" + json.dumps(parse_index_lines(index_text)) + "\n```"
+
+
+def generation_seconds(text, tokens_per_second):
+    """Returns the seconds a model generating `tokens_per_second` tokens takes to write `text`, 0 for no limit."""
+    return estimate_tokens(text) / tokens_per_second if tokens_per_second > 0 else 0.0
+
+
+def fragments(text, size=STREAM_FRAGMENT_SIZE):
+    """Splits a simulated response into the fragments of a stream."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeBackend:
+    """
+    In-process fake LLM that answers index prompts locally, see
+    `parse_index_lines`.
+
+    Args:
+        latency (float): Seconds each call takes, or a callable that draws
+            them from a random.Random, see `mock_llm_server.parse_latency`.
+        jitter (float): Maximum random seconds added to the latency.
+        seed (int): The seed of the latencies.
+        tokens_per_second (float): The simulated generation speed, after the
+            latency. 0 generates the whole response at once.
+    """
+
+    cache_id = "fake"
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0, tokens_per_second=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.tokens_per_second = tokens_per_second
+        self.calls = 0
+
+    async def wait_first_token(self):
+        self.calls += 1
+        latency = self.latency(self.random) if callable(self.latency) else self.latency
+        delay = latency + self.random.random() * self.jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def call(self, text):
+        await self.wait_first_token()
+        response = fake_index_response(text)
+        if self.tokens_per_second > 0:
+            await asyncio.sleep(generation_seconds(response, self.tokens_per_second))
+        return response
+
+    async def stream(self, text):
+        await self.wait_first_token()
+        for fragment in fragments(fake_index_response(text)):
+            # Let the consumer run between the fragments, like a network stream
+            await asyncio.sleep(generation_seconds(fragment, self.tokens_per_second))
+            yield fragment
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "openai": OpenAIBackend,
+    "local": LocalBackend,
+    "fake": FakeBackend,
+}
+
+
+def make_backend(name, **kwargs):
+    """
+    Creates an LLM backend by name.
+
+    Args:
+        name (str): One of BACKENDS: "gemini", "openai", "local" or "fake".
+        **kwargs: The arguments of the backend class.
+
+    Returns:
+        The backend. Every backend has an async `call(text)` that returns the
+        generated text or None, an async generator `stream(text)` of the
+        fragments of the generated text, an async `close()` and a `cache_id`.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"LLM backend must be one of {sorted(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
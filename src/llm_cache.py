@@ -0,0 +1,118 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Cache modes
+USE = "use"  # Read cached responses and store new ones
+REFRESH = "refresh"  # Ignore cached responses but store the new ones
+BYPASS = "bypass"  # Neither read nor store
+MODES = (USE, REFRESH, BYPASS)
+
+
+def response_key(model_url, prompt_template, text):
+    """Returns the cache key of an LLM request."""
+    digest = hashlib.sha256()
+    for part in (model_url, prompt_template, text):
+        encoded = part.encode("utf-8")
+        # Length-prefix each part so that different splits never collide
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class LLMCache:
+    """
+    Persistent, size-bounded LRU cache of LLM responses.
+
+    Entries are keyed by a hash of the model URL, the prompt template and the
+    input text (see `response_key`). When the cache grows over `max_entries`
+    entries or `max_bytes` bytes of responses, the least recently used entries
+    are evicted.
+    """
+
+    def __init__(self, path, max_entries=20000, max_bytes=256 * 1024 * 1024, mode=USE):
+        if mode not in MODES:
+            raise ValueError(f"Cache mode must be one of {MODES}")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+
+    @classmethod
+    def for_directory(cls, cache_dir, **kwargs):
+        return cls(os.path.join(cache_dir, "llm.sqlite"), **kwargs)
+
+    def get(self, key):
+        """Returns the cached response for `key`, or None."""
+        if self.mode != USE:
+            return None
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return row[0]
+
+    def put(self, key, response):
+        if self.mode == BYPASS:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), time.time()),
+            )
+            self._evict()
+
+    def _evict(self):
+        count, size = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        # Walk the entries from the least recently used one until both bounds hold
+        evicted = []
+        for key, entry_size in self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            count -= 1
+            size -= entry_size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,11 +1,13 @@
-from src.llm import llm_call
+import re
+import json
+import json_repair
+from src.llm import llm_call, llm_stream, GEMINI_URL, TruncatedResponse
+from src.llm_cache import response_key
+from src.chunker import estimate_tokens
+from src.json_stream import JSONArrayStream
+from utils.metrics import metrics
 
-
-async def llm_parse_index(index_text):
-    # Preprocess: Remove the quotation marks from the input text
-    index_text = index_text.replace('"', '')
-
-    prompt = """
+INSTRUCTIONS = """
     You are given a text from an index page of a document after OCR. 
     The index may have a hierarchical structure where parent terms are followed by subtopics. 
     Parent terms are identified by the presence of a colon (`:`) at the end of the line. 
@@ -28,9 +30,184 @@ async def llm_parse_index(index_text):
     5. Ensure there is only one parent term for each hierarchy. Avoid nested parent terms.
     6. Ignore the input if it does not resemble an index page.
     7. The text may contain misspellings or OCR errors, such as words being merged together (e.g., "wordstogetherlikethis") or spaced incorrectly (e.g., "w o r d s l i k e t h i s"). Correct these errors if appropriate.
-    
+    8. If the first line starts with "[continued]", it only repeats the parent term of the subtopics that follow it. Use it as their parent term but do not output it as a term.
+    """
+
+PACKED_INSTRUCTIONS = """
+    9. The input has several independent sections, each starting with a line "### Section <n>". Parse each section on its own, a "[continued]" line only applies to its section. Add the number of its section to each entry as "s": {{"s": n, "t": "term", "o": [[#start1, #end1]]}}.
+    """
+
+INPUT = """
     The input text is:
     {index_text}
     """
-    formatted_prompt = prompt.format(index_text=index_text)
-    return await llm_call(formatted_prompt)
+
+# Starts each section of a packed prompt
+SECTION_HEADER = "### Section {}"
+SECTION_HEADER_PATTERN = re.compile(r"^### Section (\d+)$")
+
+
+def compact_template(template):
+    """Removes the indentation and the blank lines of a prompt template."""
+    return "\n".join(line.strip() for line in template.splitlines() if line.strip())
+
+
+PROMPT_TEMPLATE = compact_template(INSTRUCTIONS + INPUT)
+PACKED_PROMPT_TEMPLATE = compact_template(INSTRUCTIONS + PACKED_INSTRUCTIONS + INPUT)
+# Tokens saved on each request by the compaction of the template
+TEMPLATE_TOKENS_SAVED = estimate_tokens(INSTRUCTIONS + INPUT) - estimate_tokens(PROMPT_TEMPLATE)
+PROMPT_TOKENS = estimate_tokens(PROMPT_TEMPLATE)
+
+
+def cache_key(index_text, client=None):
+    """Returns the LLM cache key of the response to a chunk of index text."""
+    # Responses of different backends and models are cached apart
+    model = client.cache_id if client is not None else GEMINI_URL
+    return response_key(model, PROMPT_TEMPLATE, index_text)
+
+
+def record_request(stats):
+    if stats is not None:
+        stats.requests += 1
+        stats.save("template", TEMPLATE_TOKENS_SAVED)
+
+
+async def llm_parse_index(index_text, cache=None, client=None, stats=None):
+    """
+    Parses the text of index pages with the LLM.
+
+    Args:
+        index_text (str): The text of (a chunk of) the index pages.
+        cache (LLMCache): Optional response cache. A cached response for the
+            same model, prompt template and text is returned without calling
+            the LLM.
+        client (LLMClient): Optional client, or another backend of
+            src/llm_backends.py, whose session and rate limits are reused.
+            Cached responses do not count against the rate limits.
+        stats (PromptStats): Optional, records the request and the tokens
+            saved on its prompt, see src/prompt.py.
+
+    Returns:
+        str: The raw LLM response, or None if the call failed.
+    """
+    key = cache_key(index_text, client) if cache else None
+    if cache:
+        cached = cache.get(key)
+        metrics.count("llm_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+
+    # Preprocess: Remove the quotation marks from the input text
+    index_text = index_text.replace('"', '')
+
+    formatted_prompt = PROMPT_TEMPLATE.format(index_text=index_text)
+    record_request(stats)
+    response = await llm_call(formatted_prompt, client)
+    if cache and response is not None:
+        cache.put(key, response)
+    return response
+
+
+async def llm_stream_parse_index(index_text, cache=None, client=None, stats=None):
+    """
+    Parses the text of index pages with the streaming API of the LLM, see
+    `llm_parse_index`.
+
+    Yields:
+        str: The fragments of the raw LLM response, as they are generated.
+        A cached response is yielded whole. Nothing if the call failed.
+
+    Raises:
+        TruncatedResponse: If the output was cut at the token limit. The
+            partial response is not cached.
+    """
+    key = cache_key(index_text, client) if cache else None
+    if cache:
+        cached = cache.get(key)
+        metrics.count("llm_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            yield cached
+            return
+
+    # Preprocess: Remove the quotation marks from the input text
+    index_text = index_text.replace('"', '')
+
+    formatted_prompt = PROMPT_TEMPLATE.format(index_text=index_text)
+    record_request(stats)
+    fragments = []
+    async for fragment in llm_stream(formatted_prompt, client):
+        fragments.append(fragment)
+        yield fragment
+    if cache and fragments:
+        cache.put(key, "".join(fragments))
+
+
+def split_sections(response, count):
+    """
+    Splits the response to a packed prompt by section.
+
+    Returns:
+        list: The entries of each section as a JSON list, like the response
+        to the section alone, or None for a section without entries.
+    """
+    # The first JSON list of the response, without a ```json fence or a note around it
+    decoder = JSONArrayStream()
+    entries = decoder.feed(response)
+    if decoder.invalid:
+        metrics.count("json_repairs_total", len(decoder.invalid))
+        entries.extend(json_repair.loads(item) for item in decoder.invalid)
+    sections = [[] for _ in range(count)]
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        section = entry.pop("s", None)
+        if isinstance(section, int) and 1 <= section <= count:
+            sections[section - 1].append(entry)
+    return [json.dumps(section) if section else None for section in sections]
+
+
+async def llm_parse_packed_index(index_texts, caches=None, client=None, stats=None):
+    """
+    Parses several chunks of index text with one LLM request, so the
+    instructions are sent once. The chunks are sent as numbered sections and
+    the model tags each entry with its section.
+
+    Args:
+        index_texts (list[str]): The chunks.
+        caches (list[LLMCache]): Optional cache of each chunk. The response
+            of each section is cached like the response to its chunk alone.
+        client (LLMClient): Optional client, see `llm_parse_index`.
+        stats (PromptStats): Optional, records the request and the tokens
+            saved by packing.
+
+    Returns:
+        list: The response of each chunk, as from `llm_parse_index`, or None
+        for a chunk to parse alone: the request failed or was truncated, or
+        the section has no entries.
+    """
+    caches = caches or [None] * len(index_texts)
+    sections = "\n".join(
+        SECTION_HEADER.format(i + 1) + "\n" + index_text.replace('"', '') for i, index_text in enumerate(index_texts)
+    )
+    formatted_prompt = PACKED_PROMPT_TEMPLATE.format(index_text=sections)
+    if stats is not None:
+        stats.requests += 1
+        stats.packed_requests += 1
+        stats.packed_chunks += len(index_texts)
+        stats.save("template", TEMPLATE_TOKENS_SAVED)
+        # The prompts of the other chunks, less the section headers and instructions of packing
+        overhead = estimate_tokens(formatted_prompt) - PROMPT_TOKENS - sum(map(estimate_tokens, index_texts))
+        stats.save("packing", (len(index_texts) - 1) * PROMPT_TOKENS - overhead)
+    try:
+        response = await llm_call(formatted_prompt, client)
+    except TruncatedResponse:
+        print(f"Truncated LLM response for {len(index_texts)} packed chunks, parsing them alone.")
+        return [None] * len(index_texts)
+    if response is None:
+        return [None] * len(index_texts)
+    responses = split_sections(response, len(index_texts))
+    for index_text, cache, section_response in zip(index_texts, caches, responses):
+        if cache and section_response is not None:
+            metrics.count("llm_cache_total", result="miss")
+            cache.put(cache_key(index_text, client), section_response)
+    return responses
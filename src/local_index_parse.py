@@ -0,0 +1,114 @@
+import re
+
+# A term followed by its page numbers: "term, 12, 45-7"
+ENTRY_PATTERN = re.compile(r"^(?P<term>.*?),\s*(?P<pages>\d[\d\s,\-–]*)$")
+PAGE_RANGE_PATTERN = re.compile(r"^(\d+)(?:\s*[-–]\s*(\d+))?$")
+# Characters that do not appear in clean index terms, usually OCR noise
+NOISE_PATTERN = re.compile(r"[:;|{}\[\]<>@#$%^*=~_\\]")
+# Alphabetical section headers, e.g. "A" or "B"
+SECTION_HEADER_PATTERN = re.compile(r"^[A-Z]$")
+
+
+def parse_occurrences(pages):
+    """
+    Parses the page numbers of an index line, e.g. "12, 45-7, 182-204".
+
+    Abbreviated ranges take the leading digits of their start, so "182-4" is
+    the range 182 to 184.
+
+    Returns:
+        list[tuple]: The (start, end) occurrences, or None if a part of the
+        string is not a page number or a valid range.
+    """
+    occurrences = []
+    for part in pages.split(","):
+        part = part.strip()
+        if not part:
+            return None
+        match = PAGE_RANGE_PATTERN.match(part)
+        if not match:
+            return None
+        start_str, end_str = match.group(1), match.group(2)
+        start = int(start_str)
+        if end_str is None:
+            occurrences.append((start, start))
+            continue
+        if len(end_str) < len(start_str):
+            end_str = start_str[:len(start_str) - len(end_str)] + end_str
+        end = int(end_str)
+        if end < start:
+            return None
+        occurrences.append((start, end))
+    return occurrences
+
+
+def parse_clean_line(line):
+    """
+    Parses a cleanly formatted index line, "term, 12, 45-7".
+
+    Returns:
+        tuple: The term and its occurrences, or None if the line can not be
+        parsed with confidence.
+    """
+    match = ENTRY_PATTERN.match(line)
+    if not match:
+        return None
+    term = match.group("term").strip()
+    # Lowercase terms are usually subtopics of the previous line
+    if len(term) < 2 or not term[0].isupper() or term.endswith(("-", ",")):
+        return None
+    if NOISE_PATTERN.search(term) or sum(c.isalpha() for c in term) < len(term) / 2:
+        return None
+    occurrences = parse_occurrences(match.group("pages"))
+    if not occurrences:
+        return None
+    return term, occurrences
+
+
+def split_index_text(text):
+    """
+    Splits index text into the entries that can be parsed locally and the
+    lines that need the LLM.
+
+    A line is parsed locally when it is a clean "term, pages" line and does not
+    continue the previous line. Lines without page numbers (parent terms or
+    wrapped terms), lowercase lines (subtopics), noisy lines and the lines that
+    directly follow an ambiguous line are left to the LLM. The clean line just
+    before an ambiguous group is also sent, as it may be the parent term of the
+    group.
+
+    Returns:
+        list[tuple]: Segments in text order, either (True, [(term, occurrences)])
+        for local entries or (False, [line]) for lines that need the LLM.
+    """
+    segments = []
+    previous_ambiguous = False
+    previous_line = None  # The last clean line, while it ends the last local segment
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or SECTION_HEADER_PATTERN.match(line):
+            continue
+        entry = None if previous_ambiguous else parse_clean_line(line)
+        if entry is not None:
+            if not segments or not segments[-1][0]:
+                segments.append((True, []))
+            segments[-1][1].append(entry)
+            previous_line = line
+        else:
+            if not segments or segments[-1][0]:
+                lines = []
+                if previous_line is not None:
+                    # The previous clean line may be the parent of this group
+                    segments[-1][1].pop()
+                    if not segments[-1][1]:
+                        segments.pop()
+                    lines.append(previous_line)
+                if segments and not segments[-1][0]:
+                    segments[-1][1].extend(lines)
+                else:
+                    segments.append((False, lines))
+            segments[-1][1].append(line)
+            previous_line = None
+        # A line that does not end with a page number continues on the next line
+        previous_ambiguous = entry is None and not re.search(r"\d$", line)
+    return segments
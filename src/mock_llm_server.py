@@ -0,0 +1,278 @@
+"""
+Local mock of the LLM APIs, to load-test the index pipeline offline.
+
+Answers the Gemini generateContent and streamGenerateContent and the OpenAI
+chat completions requests (streamed with "stream": true) with valid index
+JSON (see `llm_backends.fake_index_response`), after a simulated latency and
+generation time. Rate limit (429) and server (500) errors and truncated
+outputs can be injected at random:
+
+    python -m src.mock_llm_server --port 8765 --latency lognormal:0.8,0.4 --rate-429 0.05
+
+and point a `LocalBackend` (Gemini API) or an `OpenAIBackend` with
+url="http://127.0.0.1:8765/v1/chat/completions" at it.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+from aiohttp import web
+from src.llm_backends import fake_index_response, fragments, generation_seconds
+
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution, in seconds:
+
+    - "fixed:0.5"
+    - "uniform:0.2,1.0" (low, high)
+    - "exponential:0.5" (mean)
+    - "lognormal:0.8,0.4" (median, sigma of the underlying normal)
+
+    Returns:
+        callable: Draws a latency from a random.Random.
+    """
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(value) for value in params.split(",")] if params else []
+    except ValueError:
+        raise ValueError(f"Invalid latency parameters: {spec}")
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exponential" and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0]) if values[0] > 0 else 0.0
+        return lambda rng: rng.lognormvariate(mu, values[1]) if values[0] > 0 else 0.0
+    raise ValueError(f"Invalid latency distribution: {spec}")
+
+
+class MockLLMServer:
+    """
+    aiohttp server that mocks the Gemini and OpenAI APIs.
+
+    Can run in the foreground (`run`) or in a background thread (`start` and
+    `stop`, or as a context manager), e.g. in a benchmark.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on, 0 picks a free port.
+        latency (str): The latency distribution, see `parse_latency`.
+        rate_429 (float): Share of the requests answered with 429 and a
+            Retry-After header.
+        rate_500 (float): Share of the requests answered with 500.
+        rate_truncated (float): Share of the responses cut short, with the
+            MAX_TOKENS (Gemini) or "length" (OpenAI) finish reason.
+        retry_after (float): The Retry-After of the 429 responses, in seconds.
+        seed (int): The random seed of the latencies and the injected errors.
+        tokens_per_second (float): The generation speed after the latency, 0
+            to answer at once. Streamed responses send their fragments at
+            this speed.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, latency="fixed:0", rate_429=0.0, rate_500=0.0,
+                 rate_truncated=0.0, retry_after=1.0, seed=0, tokens_per_second=0.0):
+        self.host = host
+        self.port = port
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.rate_truncated = rate_truncated
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.tokens_per_second = tokens_per_second
+        self.stats = {"requests": 0, "ok": 0, "429": 0, "500": 0, "truncated": 0}
+        self.runner = None
+        self.thread = None
+        self.loop = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def gemini_url(self):
+        return f"{self.url}/v1beta/models/mock:generateContent"
+
+    @property
+    def openai_url(self):
+        return f"{self.url}/v1/chat/completions"
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/v1beta/models/{model}:generateContent", self.handle_gemini)
+        app.router.add_post("/v1beta/models/{model}:streamGenerateContent", self.handle_gemini_stream)
+        app.router.add_post("/v1/chat/completions", self.handle_openai)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    async def respond(self, prompt):
+        """
+        Returns the generated text and whether it is truncated.
+
+        Raises:
+            web.HTTPException: The injected 429 and 500 errors.
+        """
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency(self.random))
+        draw = self.random.random()
+        if draw < self.rate_429:
+            self.stats["429"] += 1
+            raise web.HTTPTooManyRequests(
+                text=json.dumps({"error": {"code": 429, "message": "Resource has been exhausted"}}),
+                content_type="application/json",
+                headers={"Retry-After": f"{self.retry_after:g}"},
+            )
+        if draw < self.rate_429 + self.rate_500:
+            self.stats["500"] += 1
+            raise web.HTTPInternalServerError(
+                text=json.dumps({"error": {"code": 500, "message": "Internal error"}}),
+                content_type="application/json",
+            )
+        text = fake_index_response(prompt)
+        if self.random.random() < self.rate_truncated:
+            self.stats["truncated"] += 1
+            return text[:self.random.randint(1, max(1, len(text) - 1))], True
+        self.stats["ok"] += 1
+        return text, False
+
+    async def send_events(self, request, events):
+        """Streams (text, event) pairs as server-sent events, each after the generation time of its text."""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        for text, event in events:
+            await asyncio.sleep(generation_seconds(text, self.tokens_per_second))
+            await response.write(f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def handle_gemini(self, request):
+        data = await request.json()
+        prompt = "".join(part.get("text", "") for content in data["contents"] for part in content["parts"])
+        text, truncated = await self.respond(prompt)
+        await asyncio.sleep(generation_seconds(text, self.tokens_per_second))
+        return web.json_response({
+            "candidates": [{
+                "content": {"parts": [{"text": text}], "role": "model"},
+                "finishReason": "MAX_TOKENS" if truncated else "STOP",
+            }],
+        })
+
+    async def handle_gemini_stream(self, request):
+        data = await request.json()
+        prompt = "".join(part.get("text", "") for content in data["contents"] for part in content["parts"])
+        text, truncated = await self.respond(prompt)
+        pieces = fragments(text)
+        events = []
+        for i, piece in enumerate(pieces):
+            candidate = {"content": {"parts": [{"text": piece}], "role": "model"}, "index": 0}
+            if i == len(pieces) - 1:
+                candidate["finishReason"] = "MAX_TOKENS" if truncated else "STOP"
+            events.append((piece, {"candidates": [candidate]}))
+        return await self.send_events(request, events)
+
+    async def handle_openai(self, request):
+        data = await request.json()
+        prompt = "".join(message.get("content", "") for message in data["messages"])
+        text, truncated = await self.respond(prompt)
+        if data.get("stream"):
+            events = [
+                (piece, {"object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": {"content": piece}, "finish_reason": None}
+                ]})
+                for piece in fragments(text)
+            ]
+            events.append(("", {"object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {}, "finish_reason": "length" if truncated else "stop"}
+            ]}))
+            events.append(("", "[DONE]"))
+            return await self.send_events(request, events)
+        await asyncio.sleep(generation_seconds(text, self.tokens_per_second))
+        return web.json_response({
+            "object": "chat.completion",
+            "model": data.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "length" if truncated else "stop",
+            }],
+        })
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def start_async(self):
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        # The actual port when the port is 0
+        self.port = self.runner.addresses[0][1]
+
+    async def stop_async(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def start(self):
+        """Starts the server in a background thread and returns once it listens."""
+        started = threading.Event()
+        errors = []
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self.start_async())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.stop_async())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self):
+        """Serves in the foreground until interrupted."""
+        print(f"Mock LLM server on {self.url}")
+        web.run_app(self.make_app(), host=self.host, port=self.port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock the Gemini and OpenAI APIs with index JSON responses.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0", help="e.g. fixed:0.5, uniform:0.2,1, lognormal:0.8,0.4")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-truncated", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Generation speed, 0 for no limit.")
+    args = parser.parse_args()
+    MockLLMServer(
+        args.host, args.port, args.latency, args.rate_429, args.rate_500, args.rate_truncated, args.retry_after,
+        args.seed, args.tokens_per_second,
+    ).run()
@@ -0,0 +1,107 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+CACHE_DIR_NAME = ".pdf_index_cache"
+
+
+def cache_dir_for(pdf_path):
+    """Returns the cache directory used for the PDFs of the folder of `pdf_path`."""
+    return os.path.join(os.path.dirname(os.path.abspath(pdf_path)), CACHE_DIR_NAME)
+
+
+def page_digest(page):
+    """
+    Computes a digest of the content of a page.
+
+    The digest covers the page geometry, the content streams, the fonts and the
+    raw streams of the XObjects drawn on the page, so it does not depend on the
+    page position in the file: the same page in another edition of a book has
+    the same digest.
+    """
+    doc = page.parent
+    digest = hashlib.sha256()
+    digest.update(f"{tuple(page.rect)}|{page.rotation}".encode())
+    digest.update(page.read_contents())
+    for font in page.get_fonts():
+        digest.update(f"|{font[3]}|{font[4]}|{font[5]}".encode())
+    for xobject in page.get_xobjects():
+        digest.update(doc.xref_stream_raw(xobject[0]) or b"")
+    return digest.hexdigest()
+
+
+class PageCache:
+    """
+    On-disk cache of extracted page data, keyed by page content digest.
+
+    Every entry has a kind ("text", "features", ...) so the different
+    extraction results of one page are cached independently. The cache can be
+    shared between threads; worker processes should open their own instance.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "digest TEXT NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (digest, kind))"
+            )
+
+    @classmethod
+    def for_pdf(cls, pdf_path, cache_dir=None):
+        return cls(os.path.join(cache_dir or cache_dir_for(pdf_path), "pages.sqlite"))
+
+    def get(self, digest, kind):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM pages WHERE digest = ? AND kind = ?", (digest, kind)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, digests, kind):
+        """Returns a dict from digest to value for the digests found in the cache."""
+        found = {}
+        digests = list(set(digests))
+        with self.lock:
+            # Stay below the SQLite limit of variables per statement
+            for i in range(0, len(digests), 500):
+                batch = digests[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT digest, value FROM pages WHERE kind = ? AND digest IN ({','.join('?' * len(batch))})",
+                    [kind, *batch],
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def put(self, digest, kind, value):
+        self.put_many([(digest, kind, value)])
+
+    def put_many(self, entries):
+        """Stores an iterable of (digest, kind, value) entries."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pages (digest, kind, value) VALUES (?, ?, ?)", entries
+            )
+
+    def get_json(self, digest, kind):
+        value = self.get(digest, kind)
+        return json.loads(value) if value is not None else None
+
+    def put_json(self, digest, kind, value):
+        self.put(digest, kind, json.dumps(value))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
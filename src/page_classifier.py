@@ -0,0 +1,86 @@
+import numpy as np
+
+# Columns of the page feature matrix
+FEATURE_COLUMNS = (
+    "numbers",  # Count of numbers in the text
+    "hits",  # Lines that look like "term, 12"
+    "lines",  # Count of non-empty lines
+    "digit_density",  # Share of digits among the non-space characters
+    "comma_ratio",  # Share of the lines that look like "term, 12"
+    "header",  # 1 if "index" is in the first 100 characters
+)
+COLUMN = {name: i for i, name in enumerate(FEATURE_COLUMNS)}
+
+# An index page should have more than 10 numbers, and either the "index"
+# header or at least 10 index entries. The other thresholds are off by default.
+DEFAULT_THRESHOLDS = {
+    "min_numbers": 10,
+    "min_hits": 10,
+    "min_comma_ratio": 0.0,
+    "min_digit_density": 0.0,
+}
+
+
+def feature_matrix(features):
+    """Builds the (pages x FEATURE_COLUMNS) matrix of a list of page features."""
+    matrix = np.zeros((len(features), len(FEATURE_COLUMNS)), dtype=np.float64)
+    for row, page in enumerate(features):
+        lines = page["lines"]
+        matrix[row] = (
+            page["numbers"],
+            page["hits"],
+            lines,
+            page["digits"] / page["chars"] if page["chars"] else 0.0,
+            page["hits"] / lines if lines else 0.0,
+            page["header"],
+        )
+    return matrix
+
+
+def candidate_mask(matrix, thresholds=None):
+    """Returns the boolean mask of the rows that look like index pages."""
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    header = matrix[:, COLUMN["header"]] > 0
+    entries = (matrix[:, COLUMN["hits"]] >= thresholds["min_hits"]) & (
+        matrix[:, COLUMN["comma_ratio"]] >= thresholds["min_comma_ratio"]
+    )
+    return (
+        (matrix[:, COLUMN["numbers"]] > thresholds["min_numbers"])
+        & (matrix[:, COLUMN["digit_density"]] >= thresholds["min_digit_density"])
+        & (header | entries)
+    )
+
+
+def is_index_candidate(features, thresholds=None):
+    """Whether a single page looks like an index page, see `candidate_mask`."""
+    return bool(candidate_mask(feature_matrix([features]), thresholds)[0])
+
+
+def classify_pages(matrix, page_numbers, thresholds=None):
+    """
+    Finds the index pages of a document.
+
+    Keeps the longest run of consecutive candidate pages, starting from its
+    first page with the "index" header.
+
+    Args:
+        matrix (np.ndarray): The feature matrix, see `feature_matrix`.
+        page_numbers (np.ndarray): The page number of each row.
+        thresholds (dict): Overrides of DEFAULT_THRESHOLDS.
+
+    Returns:
+        tuple: The candidate page numbers and the index page numbers.
+    """
+    page_numbers = np.asarray(page_numbers)
+    mask = candidate_mask(matrix, thresholds)
+    candidates = page_numbers[mask]
+    if candidates.size == 0:
+        return [], []
+    # Number the runs of consecutive pages, the first longest run wins as in a loop
+    run_ids = np.cumsum(np.concatenate(([True], np.diff(candidates) != 1)))
+    run = int(np.argmax(np.bincount(run_ids)))
+    rows = np.flatnonzero(mask)[run_ids == run]
+    header = matrix[rows, COLUMN["header"]] > 0
+    if not header.any():
+        return candidates.tolist(), []
+    return candidates.tolist(), page_numbers[rows[int(np.argmax(header)):]].tolist()
@@ -0,0 +1,312 @@
+"""
+Page labels of a document: the printed page number of each PDF page.
+
+The PDF page labels are used when the document has them. Otherwise the
+printed numbers are read from the header and footer strips of a sample of
+the pages (`get_text(clip=...)`), so a book of any length costs a few dozen
+strips instead of the text of every page:
+
+- the pages are sampled across the book in strata, so any prefix of the
+  sample covers the whole book;
+- the sampling stops once the offsets (PDF page minus printed number) of
+  the sampled pages agree with enough votes;
+- the front matter, numbered in roman numerals, and the body get their own
+  offsets, and the page where the offset changes is found by bisection.
+"""
+import re
+import random
+from collections import Counter
+import fitz
+from utils.metrics import metrics
+
+ARABIC = "arabic"
+ROMAN = "roman"
+# Numbering styles of the PDF page label rules
+PDF_STYLES = {"D": ARABIC, "r": ROMAN, "R": ROMAN}
+ARABIC_PATTERN = re.compile(r"^\d{1,4}$")
+ROMAN_PATTERN = re.compile(r"^(?=[ivxlcdm]+$)m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$")
+ROMAN_VALUES = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100, "d": 500, "m": 1000}
+ROMAN_NUMERALS = (
+    (1000, "m"), (900, "cm"), (500, "d"), (400, "cd"), (100, "c"), (90, "xc"),
+    (50, "l"), (40, "xl"), (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i"),
+)
+# Height of the header and footer strips, as a share of the page height
+STRIP_SHARE = 0.08
+# Sampled pages that must agree on the offset of the body to trust an estimate
+MIN_AGREEMENT = 5
+
+
+def roman_value(numeral):
+    """Returns the value of a roman numeral, or None if it is not one."""
+    numeral = numeral.lower()
+    if not ROMAN_PATTERN.match(numeral):
+        return None
+    values = [ROMAN_VALUES[char] for char in numeral]
+    return sum(-value if value < next_value else value for value, next_value in zip(values, values[1:] + [0]))
+
+
+def roman_numeral(value):
+    """Returns the lowercase roman numeral of a positive number."""
+    result = ""
+    for numeral_value, numeral in ROMAN_NUMERALS:
+        while value >= numeral_value:
+            result += numeral
+            value -= numeral_value
+    return result
+
+
+def label_candidates(text):
+    """
+    Returns the page number candidates of the text of a header or footer
+    strip: the first and the last word of each line, when they are an arabic
+    or a roman number.
+
+    Returns:
+        list[tuple]: The (style, number) of each candidate.
+    """
+    candidates = []
+    for line in text.splitlines():
+        words = line.split()
+        for word in {words[0], words[-1]} if words else ():
+            word = word.strip(".-–—·|[]()")
+            if ARABIC_PATTERN.match(word):
+                candidates.append((ARABIC, int(word)))
+            elif roman_value(word):
+                candidates.append((ROMAN, roman_value(word)))
+    return candidates
+
+
+def read_page_label(page, strip_share=STRIP_SHARE):
+    """Returns the page number candidates of a page, read from its top and bottom strips only."""
+    rect = page.rect
+    height = rect.height * strip_share
+    candidates = []
+    for clip in (fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + height),
+                 fitz.Rect(rect.x0, rect.y1 - height, rect.x1, rect.y1)):
+        candidates.extend(label_candidates(page.get_text("text", clip=clip)))
+    return candidates
+
+
+def stratified_pages(first, last, strata, rng):
+    """
+    Yields the pages from `first` to `last` in a random order that takes one
+    page of each of `strata` equal ranges in turn.
+    """
+    pages = list(range(first, last + 1))
+    strata = max(1, min(strata, len(pages)))
+    buckets = [pages[i * len(pages) // strata:(i + 1) * len(pages) // strata] for i in range(strata)]
+    for bucket in buckets:
+        rng.shuffle(bucket)
+    while any(buckets):
+        for bucket in buckets:
+            if bucket:
+                yield bucket.pop()
+
+
+class PageLabels:
+    """
+    The printed page numbers of a document, as segments of consecutive PDF
+    pages with one numbering style and one offset.
+
+    Args:
+        segments (list[tuple]): The (first PDF page, style, offset, prefix)
+            of each segment, by first page. The style is ARABIC, ROMAN or
+            None for unnumbered pages. The printed number of a page is the
+            page minus the offset.
+        page_count (int): The pages of the document.
+        source (str): "pdf" for the PDF page labels, "estimate" otherwise.
+        pages_read (int): The pages read to estimate the labels.
+        votes (dict): The sampled pages that agree on each (style, offset)
+            of an estimate.
+    """
+
+    def __init__(self, segments, page_count, source="estimate", pages_read=0, votes=None):
+        self.segments = sorted(segments, key=lambda segment: segment[0])
+        self.page_count = page_count
+        self.source = source
+        self.pages_read = pages_read
+        self.votes = Counter(votes or {})
+
+    @classmethod
+    def from_pdf(cls, pdf):
+        """Returns the page labels defined in the PDF, or None if it has none."""
+        segments = []
+        for rule in pdf.get_page_labels():
+            style = PDF_STYLES.get(rule.get("style"))
+            first_number = rule.get("firstpagenum", 1)
+            segments.append((rule["startpage"] + 1, style, rule["startpage"] + 1 - first_number, rule.get("prefix", "")))
+        if not any(style for _, style, _, _ in segments):
+            return None
+        return cls(segments, pdf.page_count, source="pdf")
+
+    def segment_ranges(self):
+        """Yields the (first page, last page, style, offset, prefix) of each segment."""
+        for i, (start, style, offset, prefix) in enumerate(self.segments):
+            end = self.segments[i + 1][0] - 1 if i + 1 < len(self.segments) else self.page_count
+            yield start, end, style, offset, prefix
+
+    def label(self, page_number):
+        """Returns the printed label of a PDF page (1-based), like "12" or "xii", or None if it is unnumbered."""
+        for start, end, style, offset, prefix in self.segment_ranges():
+            if not start <= page_number <= end:
+                continue
+            number = page_number - offset
+            if style is None:
+                return prefix or None
+            if number < 1:
+                return None
+            return prefix + (roman_numeral(number) if style == ROMAN else str(number))
+        return None
+
+    def difference(self, style=ARABIC):
+        """Returns the offset of the longest segment of a style, the page difference of the body, or None."""
+        lengths = Counter()
+        for start, end, segment_style, offset, prefix in self.segment_ranges():
+            if segment_style == style and not prefix:
+                lengths[offset] += end - start + 1
+        return lengths.most_common(1)[0][0] if lengths else None
+
+    def is_reliable(self, min_agreement=MIN_AGREEMENT):
+        """
+        Whether the offset of the body can be trusted: the labels come from
+        the PDF, or at least `min_agreement` sampled pages agree on it.
+        """
+        difference = self.difference()
+        if difference is None:
+            return False
+        return self.source == "pdf" or self.votes[(ARABIC, difference)] >= min_agreement
+
+    def pdf_page(self, number, style=ARABIC):
+        """
+        Returns the PDF page (1-based) of a printed page number, from the
+        segment that contains it. A number outside every segment is placed
+        with the offset of the body.
+        """
+        for start, end, segment_style, offset, prefix in self.segment_ranges():
+            if segment_style == style and not prefix and start <= number + offset <= end:
+                return number + offset
+        difference = self.difference(style)
+        return number + (difference or 0)
+
+    def report(self):
+        return {
+            "source": self.source,
+            "pages_read": self.pages_read,
+            "reliable": self.is_reliable(),
+            "segments": [
+                {"first_page": start, "last_page": end, "style": style, "offset": offset, "prefix": prefix}
+                for start, end, style, offset, prefix in self.segment_ranges()
+            ],
+        }
+
+
+def estimate_page_labels(pdf, confidence=0.9, min_votes=5, min_share=0.1, strata=16, seed=0):
+    """
+    Estimates the page labels of a document from the page numbers printed in
+    the header and footer strips of a sample of its pages.
+
+    Each number read votes for an offset of its style. The offsets with at
+    least 2 votes and `min_share` of the votes are kept, and the sampling
+    stops once they have `confidence` of the votes and `min_votes` each on
+    average, after one page of each stratum. The pages before the first
+    numbered page found, usually the front matter, are sampled the same way
+    on their own. Then the page where the offset changes between two
+    segments is found by bisection, and the unnumbered pages found at the
+    change, like a plate, are left without label.
+
+    Args:
+        pdf (fitz.Document): The open document.
+        confidence (float): The share of the votes the kept offsets must have.
+        min_votes (int): The votes needed for each kept offset.
+        min_share (float): The share of the votes of an offset to keep it.
+        strata (int): The ranges of pages sampled in turn.
+        seed (int): The random seed of the sample.
+
+    Returns:
+        PageLabels: The estimated labels, without segments if no page number
+        was found.
+    """
+    rng = random.Random(seed)
+    read = {}  # (style, offset) candidates by page
+
+    def votes(page_number):
+        if page_number not in read:
+            candidates = read_page_label(pdf.load_page(page_number - 1))
+            read[page_number] = [(style, page_number - number) for style, number in candidates]
+        return read[page_number]
+
+    def supported(pages):
+        counts = Counter(vote for page_number in pages for vote in read[page_number])
+        total = sum(counts.values())
+        kept = {key: count for key, count in counts.items() if count >= max(2, min_share * total)}
+        return kept, total
+
+    def sample(first, last):
+        """Samples the pages from first to last until the kept offsets are confident, one page of each stratum at least."""
+        pages = []
+        for page_number in stratified_pages(first, last, strata, rng):
+            votes(page_number)
+            pages.append(page_number)
+            if len(pages) < min(strata, last - first + 1):
+                continue
+            kept, total = supported(pages)
+            if kept and sum(kept.values()) >= confidence * total and total >= min_votes * len(kept):
+                break
+        return supported(pages)[0]
+
+    kept = sample(1, pdf.page_count)
+    numbered = [page_number for page_number in sorted(read) if any(vote in kept for vote in read[page_number])]
+    if numbered and numbered[0] > 1:
+        # The front matter, that the sample of the whole book may have missed
+        kept.update(sample(1, numbered[0] - 1))
+
+    def best_vote(page_number):
+        """The kept offset of a page with the most votes, or None."""
+        page_votes = [vote for vote in votes(page_number) if vote in kept]
+        return max(page_votes, key=lambda vote: kept[vote]) if page_votes else None
+
+    # Runs of consecutive sampled pages with the same offset, by page
+    runs = []  # [first page, last page, vote]
+    for page_number in sorted(read):
+        vote = best_vote(page_number) if read[page_number] else None
+        if vote is None:
+            continue
+        if runs and runs[-1][2] == vote:
+            runs[-1][1] = page_number
+        else:
+            runs.append([page_number, page_number, vote])
+
+    segments = []
+    for i, (first, _, vote) in enumerate(runs):
+        if i > 0:
+            # Bisect the pages between the two runs for the first page of this one
+            low, high = runs[i - 1][1], first
+            while high - low > 1:
+                middle = (low + high) // 2
+                # Skip the unnumbered pages around the middle
+                probe = None
+                for distance in range(high - low):
+                    for candidate in (middle + distance, middle - distance):
+                        if low < candidate < high and best_vote(candidate) in (runs[i - 1][2], vote):
+                            probe = candidate
+                            break
+                    if probe is not None:
+                        break
+                if probe is None:
+                    # Only unnumbered pages in between, like a plate
+                    segments.append((low + 1, None, 0, ""))
+                    break
+                if best_vote(probe) == vote:
+                    high = probe
+                else:
+                    low = probe
+            first = high
+        style, offset = vote
+        segments.append((first if segments else 1, style, offset, ""))
+    metrics.count("pages_scanned_total", len(read), mode="page_labels")
+    return PageLabels(segments, pdf.page_count, pages_read=len(read), votes=kept)
+
+
+def page_labels(pdf, **options):
+    """Returns the page labels of the PDF if it defines them, otherwise `estimate_page_labels`."""
+    return PageLabels.from_pdf(pdf) or estimate_page_labels(pdf, **options)
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict, deque
+import fitz
+
+
+class PageReader:
+    """
+    Reads the text of the pages of a document through one open PDF handle,
+    with an in-memory LRU cache of page text and a background thread that
+    extracts the pages likely to be read next.
+
+    PyMuPDF documents are not thread-safe, so the handle is used under a
+    lock, one page at a time: a page read in the foreground waits for at
+    most the page being prefetched.
+
+    Args:
+        document (Document): The document, its `get_page_text` extracts the
+            text through the page cache.
+        capacity (int): The number of pages kept in memory.
+    """
+
+    def __init__(self, document, capacity=256):
+        self.document = document
+        self.capacity = capacity
+        self.pages = OrderedDict()  # Page text by page number, least recently used first
+        self.pdf = None
+        self.pdf_lock = threading.Lock()
+        self.condition = threading.Condition()  # Guards pages, pending and closed
+        self.pending = deque()  # Page numbers to prefetch, in order
+        self.closed = False
+        self.thread = threading.Thread(target=self.prefetch_pages, daemon=True)
+        self.thread.start()
+
+    def cached(self, page_number):
+        with self.condition:
+            text = self.pages.get(page_number)
+            if text is not None:
+                self.pages.move_to_end(page_number)
+            return text
+
+    def store(self, page_number, text):
+        with self.condition:
+            self.pages[page_number] = text
+            self.pages.move_to_end(page_number)
+            while len(self.pages) > self.capacity:
+                self.pages.popitem(last=False)
+
+    def extract(self, page_number):
+        """Extracts the text of a page (1-based), or returns None if the page does not exist."""
+        with self.pdf_lock:
+            if self.closed:
+                return None
+            if self.pdf is None:
+                self.pdf = fitz.open(self.document.path)
+            if not 1 <= page_number <= self.pdf.page_count:
+                return None
+            return self.document.get_page_text(self.pdf, page_number)
+
+    def text(self, page_number):
+        """Returns the text of a page (1-based), or "" if the page does not exist."""
+        text = self.cached(page_number)
+        if text is None:
+            text = self.extract(page_number)
+            if text is None:
+                return ""
+            self.store(page_number, text)
+        return text
+
+    def prefetch(self, page_numbers):
+        """
+        Extracts pages in the background, in order. Replaces the pages that
+        are still waiting from the previous call, as they belong to an older
+        selection.
+        """
+        with self.condition:
+            self.pending = deque(page_numbers)
+            self.condition.notify()
+
+    def prefetch_pages(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                page_number = self.pending.popleft()
+                if page_number in self.pages:
+                    continue
+            try:
+                text = self.extract(page_number)
+            except Exception as e:
+                print(f"Error prefetching page {page_number}: {e}")
+                continue
+            if text is not None:
+                self.store(page_number, text)
+
+    def close(self):
+        """Stops the prefetch thread and closes the PDF."""
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.condition.notify()
+        self.thread.join()
+        with self.pdf_lock:
+            if self.pdf is not None:
+                self.pdf.close()
+                self.pdf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,243 @@
+import fitz
+import re
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from src.page_cache import PageCache, page_digest
+from src.page_classifier import is_index_candidate
+from utils.metrics import metrics
+
+# Simple regex to match index entries
+INDEX_ENTRY_PATTERN = re.compile(r"^[^,]+,\s*\d+", re.MULTILINE)
+# Cache kind of the page features, to change whenever the features change
+FEATURES_KIND = "features:v3"
+
+
+def page_features(text):
+    """
+    Computes the compact detection features of a page from its text.
+
+    The features do not depend on the page position, so they can be cached by
+    page content digest.
+
+    Args:
+        text (str): The text of the page, as returned by `get_text("text")`.
+
+    Returns:
+        dict: The leading and trailing numbers of the text (page number
+        candidates), the number count, the index pattern hits, the "index"
+        header flag, and the line, digit and non-space character counts.
+    """
+    # If the text starts with a number or ends with a number, it's likely the page number
+    first = re.match(r'\d+', text)
+    last = re.search(r'\d+[\s|\n]*$', text)
+    number_count = len(re.findall(r"\d+", text))
+    # The pattern is only needed for pages that have enough numbers
+    pattern_hits = len(INDEX_ENTRY_PATTERN.findall(text)) if number_count > 10 else 0
+    return {
+        "first": int(first.group(0)) if first else None,
+        "last": int(last.group(0)) if last else None,
+        "numbers": number_count,
+        "hits": pattern_hits,
+        "header": "index" in text[:100].lower(),
+        "lines": sum(1 for line in text.splitlines() if line.strip()),
+        "digits": sum(c.isdigit() for c in text),
+        "chars": sum(not c.isspace() for c in text),
+    }
+
+
+def page_offsets(features):
+    """Returns the page number difference candidates of a scanned page."""
+    return [features["page"] - number for number in (features["first"], features["last"]) if number is not None]
+
+
+def scan_page_range(path, start, end, cache_path=None):
+    """
+    Computes the features of the pages `start` to `end` (1-based, inclusive).
+
+    Opens its own document handle and cache connection so it can run in a
+    worker process. The cache is only read here: the pages that were not found
+    are returned so that the caller can store them.
+
+    Returns:
+        tuple: The list of page features, each with its "page" number and
+        "digest", and the list of (digest, text, features) of the cache misses.
+    """
+    cache = PageCache(cache_path) if cache_path else None
+    features = []
+    misses = []
+    try:
+        with fitz.open(path) as pdf:
+            for page_number in range(start, end + 1):
+                page, miss = read_page_features(pdf, page_number, cache)
+                features.append(page)
+                if miss:
+                    misses.append(miss)
+    finally:
+        if cache:
+            cache.close()
+    return features, misses
+
+
+def read_page_features(pdf, page_number, cache=None):
+    """
+    Returns the features of a page, with its "page" number and "digest", and
+    the (digest, text, features) to store if it was not found in the cache.
+    """
+    page = pdf.load_page(page_number - 1)
+    digest = page_digest(page) if cache else None
+    cached = cache.get_json(digest, FEATURES_KIND) if cache else None
+    miss = None
+    if cached is None:
+        # Only the plain text: the detection costs about one text extraction per page
+        text = page.get_text("text")
+        cached = page_features(text)
+        if cache:
+            miss = (digest, text, cached)
+    return dict(cached, page=page_number, digest=digest), miss
+
+
+def store_misses(cache, misses):
+    cache.put_many(
+        entry
+        for digest, text, page in misses
+        for entry in ((digest, "text", text), (digest, FEATURES_KIND, json.dumps(page)))
+    )
+
+
+def split_page_range(page_count, parts):
+    """Splits the pages 1..page_count into at most `parts` contiguous ranges."""
+    parts = max(1, min(parts, page_count))
+    size, extra = divmod(page_count, parts)
+    ranges = []
+    start = 1
+    for i in range(parts):
+        end = start + size - 1 + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def scan_pages(path, workers=1, cache=None):
+    """
+    Computes the features of every page of the document, in page order.
+
+    Args:
+        path (str): The path of the PDF file.
+        workers (int): The number of worker processes. `None` uses one per CPU,
+            1 scans in the current process.
+        cache (PageCache): Optional cache of page text and features. Only the
+            pages whose digest is not in the cache are extracted.
+
+    Returns:
+        list[dict]: The features of each page, see `page_features`.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with fitz.open(path) as pdf:
+        page_count = pdf.page_count
+    if page_count == 0:
+        return []
+    cache_path = cache.path if cache else None
+
+    if workers <= 1 or page_count < 2:
+        results = [scan_page_range(path, 1, page_count, cache_path)]
+    else:
+        # Use more ranges than workers so that a slow range does not stall the pool
+        ranges = split_page_range(page_count, workers * 4)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(scan_page_range, path, start, end, cache_path) for start, end in ranges]
+            results = [future.result() for future in futures]
+
+    features = []
+    for range_features, misses in results:
+        features.extend(range_features)
+        metrics.count("pages_scanned_total", len(range_features), mode="full")
+        metrics.count("page_cache_misses_total", len(misses), mode="full")
+        if cache and misses:
+            store_misses(cache, misses)
+    return features
+
+
+def toc_index_page(pdf):
+    """Returns the page of the last outline entry named "index", or None."""
+    pages = [page for _, title, page in pdf.get_toc() if "index" in title.lower() and page > 0]
+    return pages[-1] if pages else None
+
+
+def locate_index_pages(path, cache=None, use_toc=True, max_tail_pages=None, gap=3, thresholds=None):
+    """
+    Locates the index pages from the end of the book, without reading the
+    whole document.
+
+    The run of index pages is searched from the outline entry named "index" if
+    there is one, otherwise backward from the last page, skipping at most
+    `max_tail_pages` pages of back matter. The search stops `gap` pages past the
+    run. As in the full scan, the run must start with a page that has "index"
+    in its header.
+
+    Args:
+        path (str): The path of the PDF file.
+        cache (PageCache): Optional cache of page text and features.
+        use_toc (bool): Whether to probe the document outline first.
+        max_tail_pages (int): The pages allowed after the index. Defaults to a
+            tenth of the document, at least 20 pages.
+        gap (int): The pages checked past the run to make sure it ended.
+        thresholds (dict): Overrides of the index page classifier thresholds.
+
+    Returns:
+        tuple: The index page numbers and the features of the pages that were
+        read, or None when the index could not be located with confidence.
+    """
+    scanned = {}
+    misses = []
+
+    def read(pdf, page_number):
+        if page_number not in scanned:
+            scanned[page_number], miss = read_page_features(pdf, page_number, cache)
+            if miss:
+                misses.append(miss)
+        return scanned[page_number]
+
+    def is_index(pdf, page_number):
+        return 1 <= page_number <= pdf.page_count and is_index_candidate(read(pdf, page_number), thresholds)
+
+    run = []
+    with fitz.open(path) as pdf:
+        page_count = pdf.page_count
+        if max_tail_pages is None:
+            max_tail_pages = max(20, page_count // 10)
+        toc_page = toc_index_page(pdf) if use_toc else None
+        if toc_page is not None and is_index(pdf, toc_page):
+            # Walk back in case the outline points inside the index, then forward
+            first = toc_page
+            while is_index(pdf, first - 1):
+                first -= 1
+            last = toc_page
+            while is_index(pdf, last + 1):
+                last += 1
+        else:
+            last = page_count
+            while last > page_count - max_tail_pages and last >= 1 and not is_index(pdf, last):
+                last -= 1
+            if last <= page_count - max_tail_pages or last < 1:
+                last = None
+            first = last
+            while first is not None and is_index(pdf, first - 1):
+                first -= 1
+        if last is not None:
+            run = list(range(first, last + 1))
+            # Another index run just before this one: the heuristic is not sure which one to use
+            if any(is_index(pdf, page_number) for page_number in range(first - gap - 1, first - 1)):
+                run = []
+
+    metrics.count("pages_scanned_total", len(scanned), mode="backward")
+    metrics.count("page_cache_misses_total", len(misses), mode="backward")
+    if cache and misses:
+        store_misses(cache, misses)
+    # The begin of the index sequence should contain the word "index"
+    while run and not scanned[run[0]]["header"]:
+        run = run[1:]
+    if not run:
+        return None
+    return run, [scanned[page_number] for page_number in sorted(scanned)]
@@ -0,0 +1,216 @@
+"""
+Prompt layer of the LLM parse: fewer input tokens per index page.
+
+- `compact_text` collapses the runs of whitespace of the extracted text and
+  drops its blank lines.
+- `strip_running_lines` removes the running headers and footers that repeat
+  at the top or bottom of the index pages, like "Index" or the page numbers.
+- `RequestPacker` sends the small chunks parsed around the same time, by one
+  or several documents, as the sections of one request, so the instructions
+  are sent once.
+
+`PromptStats` adds up the tokens saved in a run, also counted in the
+"prompt_tokens_saved_total" metric.
+"""
+import re
+import math
+import asyncio
+from collections import Counter
+from src.chunker import estimate_tokens, estimate_output_tokens
+from src.llm_index_parse import llm_parse_packed_index, cache_key
+from utils.metrics import metrics
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Soft hyphens, zero-width spaces and joiners, and byte order marks
+INVISIBLE_PATTERN = re.compile("[\u00ad\u200b-\u200d\ufeff]")
+DIGITS_PATTERN = re.compile(r"\d+")
+# Lines at the top and at the bottom of a page that can be running headers or footers
+EDGE_LINES = 2
+# Share of the pages a running header or footer is on
+RUNNING_LINE_MIN_SHARE = 0.5
+# Chunks of at most this share of the budget of a request can be packed
+SMALL_CHUNK_SHARE = 0.5
+
+
+def compact_line(line):
+    return WHITESPACE_PATTERN.sub(" ", INVISIBLE_PATTERN.sub("", line)).strip()
+
+
+def compact_text(text):
+    """Collapses the runs of whitespace of each line and drops the blank lines."""
+    lines = (compact_line(line) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def running_line_key(line):
+    """The line with its numbers replaced, so the footers "12" and "13" are the same line."""
+    return DIGITS_PATTERN.sub("#", compact_line(line).lower())
+
+
+def edge_positions(line_count, edge_lines=EDGE_LINES):
+    return set(range(min(edge_lines, line_count))) | set(range(max(0, line_count - edge_lines), line_count))
+
+
+def strip_running_lines(pages, edge_lines=EDGE_LINES, min_share=RUNNING_LINE_MIN_SHARE):
+    """
+    Removes the running headers and footers of the index pages: the lines
+    among the first and last `edge_lines` of a page that are on at least
+    `min_share` of the pages, and on 2 pages at least, up to their numbers.
+
+    Args:
+        pages (list[str]): The text of each page.
+
+    Returns:
+        tuple: The text of each page without those lines, and the removed lines.
+    """
+    pages = [[line for line in page.splitlines() if line.strip()] for page in pages]
+    counts = Counter()
+    for lines in pages:
+        counts.update({running_line_key(lines[i]) for i in edge_positions(len(lines), edge_lines)})
+    threshold = max(2, math.ceil(min_share * len(pages)))
+    running = {key for key, count in counts.items() if count >= threshold}
+    stripped = []
+    removed = []
+    for lines in pages:
+        edges = edge_positions(len(lines), edge_lines)
+        kept = []
+        for i, line in enumerate(lines):
+            if i in edges and running_line_key(line) in running:
+                removed.append(line)
+            else:
+                kept.append(line)
+        stripped.append("\n".join(kept))
+    return stripped, removed
+
+
+def chunk_tokens(text):
+    """Estimates the input and output tokens of a chunk, see src/chunker.py."""
+    lines = text.splitlines()
+    return sum(estimate_tokens(line) + 1 for line in lines), sum(estimate_output_tokens(line) for line in lines)
+
+
+class PromptStats:
+    """Estimated input tokens saved by the prompt layer, and the requests sent."""
+
+    def __init__(self):
+        # Tokens saved by "whitespace" and "running_lines" compaction, the
+        # compact "template" and "packing"
+        self.saved = Counter()
+        self.running_lines = 0  # Header and footer lines removed
+        self.requests = 0  # LLM requests
+        self.packed_requests = 0  # Requests of several chunks
+        self.packed_chunks = 0  # Chunks sent in packed requests
+
+    def save(self, reason, tokens):
+        self.saved[reason] += tokens
+        metrics.count("prompt_tokens_saved_total", tokens, reason=reason)
+
+    def add(self, other):
+        """Adds the counts of another run, like a document of a batch."""
+        self.saved.update(other.saved)
+        self.running_lines += other.running_lines
+        self.requests += other.requests
+        self.packed_requests += other.packed_requests
+        self.packed_chunks += other.packed_chunks
+
+    def report(self):
+        return {
+            "tokens_saved": sum(self.saved.values()),
+            "tokens_saved_by": dict(self.saved),
+            "running_lines_removed": self.running_lines,
+            "requests": self.requests,
+            "packed_requests": self.packed_requests,
+            "packed_chunks": self.packed_chunks,
+        }
+
+    def summary(self):
+        saved = ", ".join(f"{reason} {tokens}" for reason, tokens in sorted(self.saved.items()) if tokens)
+        return (f"Prompt tokens saved: {sum(self.saved.values())} ({saved or 'none'}), "
+                f"{self.requests} LLM requests, {self.packed_chunks} chunks in {self.packed_requests} packed requests")
+
+
+class RequestPacker:
+    """
+    Packs the small chunks of index text that wait for the LLM at the same
+    time into one request, see `llm_parse_packed_index`.
+
+    A small chunk waits up to `delay` seconds for others. A group is sent
+    when it fills the token budget or when the delay is over. A chunk left
+    alone, or whose section of the packed response is missing, is returned
+    to the caller to parse alone.
+
+    Args:
+        client (LLMClient): The client of the requests, shared by the callers.
+        max_input_tokens (int): The input token budget of a request, without the prompt.
+        max_output_tokens (int): The output token budget of a request.
+        delay (float): Seconds a chunk waits for other chunks.
+    """
+
+    def __init__(self, client, max_input_tokens=6000, max_output_tokens=6000, delay=0.05):
+        self.client = client
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.delay = delay
+        self.stats = PromptStats()
+        self.pending = []  # (text, cache, future) of the next request
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.timer = None
+        self.requests = set()  # Requests being sent, so they are not garbage collected
+
+    def is_small(self, text):
+        input_tokens, output_tokens = chunk_tokens(text)
+        return (input_tokens <= SMALL_CHUNK_SHARE * self.max_input_tokens
+                and output_tokens <= SMALL_CHUNK_SHARE * self.max_output_tokens)
+
+    async def parse(self, text, cache=None):
+        """
+        Parses a small chunk in a packed request.
+
+        Returns:
+            str: The response to the chunk, or None if it must be parsed alone.
+        """
+        if cache:
+            cached = cache.get(cache_key(text, self.client))
+            if cached is not None:
+                metrics.count("llm_cache_total", result="hit")
+                return cached
+        input_tokens, output_tokens = chunk_tokens(text)
+        if (self.input_tokens + input_tokens > self.max_input_tokens
+                or self.output_tokens + output_tokens > self.max_output_tokens):
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, cache, future))
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self):
+        """Sends the pending chunks."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # Skip the chunks whose caller stopped waiting
+        group = [item for item in self.pending if not item[2].done()]
+        self.pending = []
+        self.input_tokens = self.output_tokens = 0
+        if len(group) == 1:
+            group[0][2].set_result(None)
+        elif group:
+            request = asyncio.ensure_future(self.send(group))
+            self.requests.add(request)
+            request.add_done_callback(self.requests.discard)
+
+    async def send(self, group):
+        texts = [text for text, _, _ in group]
+        caches = [cache for _, cache, _ in group]
+        try:
+            responses = await llm_parse_packed_index(texts, caches, self.client, self.stats)
+        except Exception as e:
+            print(f"Error parsing {len(group)} packed chunks, parsing them alone: {type(e).__name__}: {e}")
+            responses = [None] * len(group)
+        for (_, _, future), response in zip(group, responses):
+            if not future.done():
+                future.set_result(response)
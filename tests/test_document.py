@@ -0,0 +1,86 @@
+import asyncio
+from src.document import Document
+from src.llm import TruncatedResponse, StreamInterrupted
+
+INDEX_TEXT = "apple, 12\nbanana, 14-15"
+ENTRIES = '[{"t": "apple", "o": [[12, 12]]}, {"t": "banana", "o": [[14, 15]]}]'
+
+
+class ResponseBackend:
+    """LLM backend that answers every prompt with the same response."""
+
+    cache_id = "test"
+
+    def __init__(self, response, truncated=False, interrupt_at=None):
+        self.response = response
+        self.truncated = truncated
+        self.interrupt_at = interrupt_at  # Characters streamed before the connection fails
+        self.calls = 0
+
+    async def call(self, text):
+        self.calls += 1
+        if self.truncated:
+            raise TruncatedResponse(self.response)
+        return self.response
+
+    async def stream(self, text):
+        self.calls += 1
+        for i in range(0, len(self.response), 8):
+            if self.interrupt_at is not None and i >= self.interrupt_at:
+                raise StreamInterrupted(self.response[:i], "ClientPayloadError")
+            yield self.response[i:i + 8]
+        if self.truncated:
+            raise TruncatedResponse(self.response)
+
+
+def parse_chunk(backend):
+    document = Document("pdf", "book.pdf", use_cache=False, llm_client=backend)
+    entries = asyncio.run(document.process_chunk(INDEX_TEXT))
+    return document, [(entry.term, list(entry.occurrences)) for entry in entries]
+
+
+def stream_chunk(backend):
+    document = Document("pdf", "book.pdf", use_cache=False, llm_client=backend)
+    entries = []
+    asyncio.run(document.stream_chunk(INDEX_TEXT, entries.extend))
+    return document, [(entry.term, list(entry.occurrences)) for entry in entries]
+
+
+def test_note_after_the_list_is_not_a_truncation():
+    backend = ResponseBackend("```json\n" + ENTRIES + "\n```\nNote: the page ranges were kept as printed.")
+    document, entries = parse_chunk(backend)
+    assert entries == [("apple", [(12, 12)]), ("banana", [(14, 15)])]
+    assert backend.calls == 1
+    assert document.failed_chunks == 0
+
+
+def test_truncated_response_is_split():
+    backend = ResponseBackend('[{"t": "apple", "o": [[12, 12]]}, {"t": "ban', truncated=True)
+    document, entries = parse_chunk(backend)
+    assert backend.calls > 1
+    assert document.failed_chunks > 0
+
+
+def test_list_without_end_is_not_split():
+    for parse in (parse_chunk, stream_chunk):
+        backend = ResponseBackend('[{"t": "apple", "o": [[12, 12]]}, {"t": "ban')
+        document, entries = parse(backend)
+        assert entries == [("apple", [(12, 12)])]
+        assert backend.calls == 1
+        # Not saved as a complete index
+        assert document.failed_chunks == 1
+
+
+def test_streamed_note_after_the_list_is_not_a_truncation():
+    backend = ResponseBackend("```json\n" + ENTRIES + "\n```\nNote: the page ranges were kept as printed.")
+    document, entries = stream_chunk(backend)
+    assert entries == [("apple", [(12, 12)]), ("banana", [(14, 15)])]
+    assert document.failed_chunks == 0
+
+
+def test_interrupted_stream_is_parsed_again():
+    backend = ResponseBackend(ENTRIES, interrupt_at=40)
+    document, entries = stream_chunk(backend)
+    assert entries == [("apple", [(12, 12)]), ("banana", [(14, 15)])]
+    assert backend.calls == 2
+    assert document.failed_chunks == 0
@@ -0,0 +1,35 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from src.llm import LLMClient
+
+GEMINI_RESPONSE = {"candidates": [{"content": {"parts": [{"text": "[]"}]}, "finishReason": "STOP"}]}
+
+
+def serve(responses, request):
+    """Calls `request(url)` with a server that answers with `responses` in turn, returns its result and the requests."""
+    requests = []
+
+    async def handle(_):
+        response = responses[min(len(requests), len(responses) - 1)]
+        requests.append(response)
+        return response()
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/model:generateContent", handle)
+        async with TestServer(app) as server:
+            return await request(str(server.make_url("/model:generateContent")))
+
+    return asyncio.run(run()), len(requests)
+
+
+def test_call_retries_a_body_that_is_not_json():
+    async def request(url):
+        async with LLMClient(api_key="key", url=url, backoff=0) as client:
+            return await client.call("prompt")
+
+    html = lambda: web.Response(text="<html>Bad gateway</html>", content_type="text/html")
+    text, requests = serve([html, lambda: web.json_response(GEMINI_RESPONSE)], request)
+    assert text == "[]"
+    assert requests == 2
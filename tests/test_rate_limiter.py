@@ -0,0 +1,47 @@
+import time
+import asyncio
+from utils.rate_limiter import RateLimiter, KeyPool
+
+# Slack for the timer resolution of the event loop, in seconds
+TOLERANCE = 0.01
+
+
+def call_times(acquire, calls):
+    async def run():
+        times = []
+
+        async def call():
+            await acquire()
+            times.append(time.monotonic())
+
+        await asyncio.gather(*(call() for _ in range(calls)))
+        return sorted(times)
+
+    return asyncio.run(run())
+
+
+def most_calls_in_a_window(times, period):
+    """The most calls that start within `period` seconds of each other."""
+    return max(sum(1 for other in times if start <= other < start + period - TOLERANCE) for start in times)
+
+
+def test_rate_limiter_caps_every_window():
+    limiter = RateLimiter(5, 0.3)
+    times = call_times(limiter.acquire, 17)
+    assert most_calls_in_a_window(times, 0.3) == 5
+    # The first calls are not delayed
+    assert times[4] - times[0] < TOLERANCE
+
+
+def test_key_pool_caps_every_window_of_each_key():
+    pool = KeyPool(["a", "b"], max_calls=3, period=0.3)
+    keys = []
+
+    async def acquire():
+        keys.append((await pool.acquire(), time.monotonic()))
+
+    call_times(acquire, 14)
+    for key in ("a", "b"):
+        assert most_calls_in_a_window([start for used, start in keys if used == key], 0.3) == 3
+    # Both keys are used from the start
+    assert most_calls_in_a_window([start for _, start in keys], 0.3) == 6
@@ -0,0 +1,232 @@
+"""
+Counters and latency histograms of the index pipeline.
+
+The pipeline records into the module-level `metrics` registry:
+
+    metrics.count("llm_requests_total", status=200)
+    with metrics.timer("stage_seconds", stage="scan_pages"):
+        ...
+
+The registry is disabled unless `metrics.enable()` is called or the
+PDF_INDEX_METRICS environment variable is set, to the path where the GUI
+writes its report. While disabled, `count` and `observe` return right away
+and `timer` returns a shared no-op context manager, so the instrumentation
+costs well under a microsecond per call.
+
+The results are exported as a JSON run report (`write_json`) or in the
+Prometheus text format (`write_prometheus`), with names prefixed by
+"pdf_index_".
+"""
+import os
+import json
+import math
+import time
+import threading
+from bisect import bisect_left
+
+PREFIX = "pdf_index_"
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    """Renders labels the Prometheus way: {name="value",...}, or "" without labels."""
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    escape = lambda value: value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in items) + "}"
+
+
+def format_bound(bound):
+    return "+Inf" if math.isinf(bound) else f"{bound:g}"
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets, with their count, sum, minimum and maximum."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets) + (math.inf,)
+        self.counts = [0] * len(self.bounds)  # Not cumulative
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.bounds[i - 1] if i else 0.0
+                high = self.bounds[i]
+                low, high = max(low, self.min), min(high, self.max)
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0, "sum": 0.0}
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {format_bound(bound): count for bound, count in zip(self.bounds, self.counts)},
+        }
+
+
+class Timer:
+    """Context manager that observes its duration in a histogram, in seconds."""
+
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """
+    Registry of counters and histograms, identified by a name and labels.
+    Thread-safe. Metrics of worker processes are not collected.
+
+    Args:
+        enabled (bool): Whether to record, see `enable`.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}  # Value by name and label key
+        self.histograms = {}  # Histogram by name and label key
+        self.started = time.time()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def count(self, name, value=1, **labels):
+        """Adds `value` to a counter."""
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records a value, usually seconds, in a histogram."""
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Returns a context manager that records the seconds it runs in a histogram."""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def report(self):
+        """Returns the JSON run report: the counters and the summary of each histogram."""
+        with self.lock:
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "duration_seconds": time.time() - self.started,
+                "counters": {
+                    name + format_labels(labels): value for (name, labels), value in sorted(self.counters.items())
+                },
+                "histograms": {
+                    name + format_labels(labels): histogram.summary()
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                },
+            }
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} counter")
+                lines.append(f"{PREFIX}{name}{format_labels(labels)} {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    bucket_labels = format_labels(labels, [("le", format_bound(bound))])
+                    lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum:g}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_prometheus(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+
+    def write_reports(self, path):
+        """Writes the JSON report to `path` and the Prometheus metrics next to it, with the .prom extension."""
+        self.write_json(path)
+        self.write_prometheus(os.path.splitext(path)[0] + ".prom")
+
+
+# The registry of the pipeline
+metrics = Metrics(enabled=bool(os.getenv("PDF_INDEX_METRICS")))
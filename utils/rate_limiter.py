@@ -0,0 +1,73 @@
+import time
+import asyncio
+from collections import deque
+from utils.metrics import metrics
+
+
+class RateLimiter:
+    """
+    Allows at most `max_calls` calls in any window of `period` seconds.
+
+    The start times of the last `max_calls` calls are kept, and a call is
+    scheduled `period` seconds after the call `max_calls` before it. Acquiring
+    reserves that time right away and then sleeps exactly until it: every
+    acquire is O(1) and waiters never re-check the limiter.
+    """
+
+    def __init__(self, max_calls, period):
+        if max_calls <= 0 or period <= 0:
+            raise ValueError("Max calls and period must be positive")
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque(maxlen=max_calls)  # Start times of the last calls, reserved ones included, in order
+
+    def _next_start(self, now):
+        if len(self.calls) < self.max_calls:
+            return now
+        return max(now, self.calls[0] + self.period)
+
+    def delay(self):
+        """Returns the seconds until a call would be allowed, without reserving it."""
+        now = time.monotonic()
+        return self._next_start(now) - now
+
+    def reserve(self):
+        """Reserves the next allowed call and returns the seconds to wait before making it."""
+        now = time.monotonic()
+        start = self._next_start(now)
+        self.calls.append(start)
+        return start - now
+
+    async def acquire(self):
+        wait = self.reserve()
+        metrics.observe("rate_limit_wait_seconds", wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class KeyPool:
+    """
+    Pool of API keys, each with its own rate limit.
+
+    `acquire` picks the key whose limiter allows a call first, so the total
+    throughput grows with the number of keys.
+    """
+
+    def __init__(self, keys, max_calls=15, period=60):
+        keys = [key for key in keys if key]
+        if not keys:
+            raise ValueError("The key pool needs at least one API key")
+        self.limiters = [(key, RateLimiter(max_calls, period)) for key in keys]
+
+    def __len__(self):
+        return len(self.limiters)
+
+    async def acquire(self):
+        """Waits for the rate limit of the least busy key and returns that key."""
+        key, limiter = min(self.limiters, key=lambda item: item[1].delay())
+        wait = limiter.reserve()
+        metrics.observe("rate_limit_wait_seconds", wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return key
+
@@ -0,0 +1,119 @@
+import tkinter as tk
+
+
+class VirtualList(tk.Frame):
+    """
+    Scrollable list that only creates the rows in view.
+
+    The rows are not stored: the list asks `row_count` for their number and
+    `row_text` for the text of the rows it shows, so lists of any length
+    open and scroll in constant time. Call `refresh` when rows are added and
+    `reset` when the rows change.
+
+    Args:
+        master: The parent widget.
+        row_count (callable): Returns the number of rows.
+        row_text (callable): Returns the text of a row from its position.
+        command (callable): Called with the position of the selected row.
+        height (int): The number of rows shown before the list is resized.
+        **kwargs: Options of the inner Listbox.
+    """
+
+    def __init__(self, master, row_count, row_text, command=None, height=15, **kwargs):
+        super().__init__(master)
+        self.row_count = row_count
+        self.row_text = row_text
+        self.command = command
+        self.top = 0  # Position of the first row in view
+        self.visible = height  # Number of rows in view
+        self.selected = None  # Position of the selected row
+        self.rendered = None  # Rows in the listbox, to skip redrawing the same rows
+
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self, height=height, exportselection=False, activestyle="none", **kwargs)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<Configure>", self.on_resize)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.listbox.bind(sequence, self.on_wheel)
+        self.listbox.bind("<Up>", lambda event: self.move_selection(-1))
+        self.listbox.bind("<Down>", lambda event: self.move_selection(1))
+        self.listbox.bind("<Prior>", lambda event: self.move_selection(-self.visible))
+        self.listbox.bind("<Next>", lambda event: self.move_selection(self.visible))
+        self.listbox.bind("<Home>", lambda event: self.move_selection(-self.row_count()))
+        self.listbox.bind("<End>", lambda event: self.move_selection(self.row_count()))
+
+    def reset(self):
+        """Shows the first rows of new content."""
+        self.top = 0
+        self.selected = None
+        self.rendered = None
+        self.refresh()
+
+    def refresh(self):
+        """Redraws the rows in view if they changed, and updates the scrollbar."""
+        count = self.row_count()
+        self.top = max(0, min(self.top, count - self.visible))
+        rows = [self.row_text(position) for position in range(self.top, min(count, self.top + self.visible))]
+        if rows != self.rendered:
+            self.listbox.delete(0, tk.END)
+            self.listbox.insert(0, *rows)
+            self.listbox.yview_moveto(0)
+            self.rendered = rows
+            if self.selected is not None and 0 <= self.selected - self.top < len(rows):
+                self.listbox.selection_set(self.selected - self.top)
+        if count:
+            self.scrollbar.set(self.top / count, min(1.0, (self.top + self.visible) / count))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll_to(self, top):
+        self.top = top
+        self.refresh()
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * self.row_count()))
+        elif action == "scroll":
+            self.scroll_to(self.top + int(amount) * (self.visible if unit == "pages" else 1))
+
+    def on_wheel(self, event):
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+        self.scroll_to(self.top + (-3 if up else 3))
+        return "break"
+
+    def on_resize(self, event):
+        # The height of a row, from a drawn row or the font
+        bbox = self.listbox.bbox(0)
+        row_height = bbox[3] + 1 if bbox else max(1, int(self.listbox.winfo_reqheight() / self.visible))
+        visible = max(1, event.height // row_height)
+        if visible != self.visible:
+            self.visible = visible
+            self.rendered = None
+            self.refresh()
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        self.selected = self.top + selection[0]
+        if self.command is not None:
+            self.command(self.selected)
+
+    def move_selection(self, step):
+        """Moves the selection by `step` rows, scrolling to keep it in view."""
+        count = self.row_count()
+        if not count:
+            return "break"
+        current = self.selected if self.selected is not None else self.top - (step > 0)
+        self.selected = max(0, min(count - 1, current + step))
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + self.visible:
+            self.top = self.selected - self.visible + 1
+        self.rendered = None
+        self.refresh()
+        if self.command is not None:
+            self.command(self.selected)
+        return "break"